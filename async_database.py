@@ -0,0 +1,133 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+import pymongo
+from pymongo import AsyncMongoClient
+import config
+import database as db
+
+# The database calls on the bot's hot paths, async so a Mongo round trip no longer stalls every
+# other update; database.py has no sync copies of them. They share database.py's in-memory
+# caches and query helpers, so both layers stay consistent. Rare paths (settings refresh, video index edits, media registry misses) call the
+# sync functions through asyncio.to_thread; the Flask dashboard keeps using database.py.
+
+_client = None
+_client_loop = None
+_pool_stats = None
+
+def _db():
+    # AsyncMongoClient is bound to the event loop it is used on; polling restarts get a new loop
+    global _client, _client_loop, _pool_stats
+    loop = asyncio.get_running_loop()
+    if _client is None or _client_loop is not loop:
+        _pool_stats = db.PoolStats()
+        _client = AsyncMongoClient(config.MONGO_URI, **db.client_options(_pool_stats))
+        _client_loop = loop
+    return _client[config.DB_NAME]
+
+async def close():
+    """Closes the client on the loop it belongs to; the bot calls this when the application shuts
+    down, before a polling restart starts a new loop."""
+    global _client, _client_loop
+    if _client is not None and _client_loop is asyncio.get_running_loop():
+        await _client.close()
+    _client = _client_loop = None
+
+def pool_stats():
+    return _pool_stats.snapshot() if _pool_stats else {}
+
+# --- User Operations ---
+async def get_user(user_id, fresh=False):
+    user = None if fresh else db.get_cached_user(int(user_id))
+    now = datetime.now()
+
+    if user is None:
+        user = await _db().users.find_one_and_update(
+            {"user_id": int(user_id)},
+            {"$setOnInsert": db.new_user_fields(now)},
+            upsert=True,
+            return_document=pymongo.ReturnDocument.BEFORE
+        )
+        if user is None:
+            user = {"user_id": int(user_id), **db.new_user_fields(now)}
+            await bump_daily_stat("signups", now)
+        db.cache_user(user)
+
+    return db.with_subscription_state(user, now)
+
+async def mark_demo_used(user_id):
+    await _db().users.update_one({"user_id": int(user_id)}, {"$set": {"demo_used": True}})
+    db.update_cached_user(user_id, {"demo_used": True})
+
+async def update_user_subscription(user_id, days=0, minutes=0):
+    user = await _db().users.find_one_and_update(
+        {"user_id": int(user_id)},
+        db.subscription_extension(datetime.now(), days, minutes),
+        return_document=pymongo.ReturnDocument.AFTER
+    )
+    if user:
+        db.cache_user(user)
+
+async def update_view_state(user_id, index, message_id):
+    fields = {"current_video_index": index, "last_message_id": message_id}
+    await _db().users.update_one({"user_id": int(user_id)}, {"$set": fields})
+    db.update_cached_user(user_id, fields)
+
+async def expire_due_users(now=None):
+    """Flips every user whose plan ran out. Returns the ones that still hold a video message."""
+    now = now or datetime.now()
+    users = _db().users
+    vanish = await users.find(
+        {"subscription_expiry": {"$lt": now}, "last_message_id": {"$ne": None}},
+        {"user_id": 1, "last_message_id": 1, "demo_used": 1}
+    ).to_list()
+    result = await users.update_many(
+        {"subscription_expiry": {"$lt": now}, "$or": [{"is_subscribed": True}, {"last_message_id": {"$ne": None}}]},
+        {"$set": {"is_subscribed": False, "last_message_id": None}}
+    )
+    if result.modified_count:
+        await bump_daily_stat("expirations", now, result.modified_count)
+    db.expire_cached_users(now)
+    return vanish
+
+# --- Pending Payment Operations ---
+async def set_pending_payment(user_id, plan_name, plan, order_id=None):
+    await _db().pending_payments.update_one(
+        {"_id": int(user_id)},
+        {"$set": {"plan_name": plan_name, "plan": plan, "order_id": order_id,
+                  "selected_at": datetime.now(), "created_at": datetime.now(timezone.utc)}},
+        upsert=True
+    )
+
+async def get_pending_payment(user_id):
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=config.PENDING_PAYMENT_TTL)
+    return await _db().pending_payments.find_one({"_id": int(user_id), "created_at": {"$gt": cutoff}})
+
+async def clear_pending_payment(user_id):
+    await _db().pending_payments.delete_one({"_id": int(user_id)})
+
+# --- Order Operations ---
+async def create_order(order_id, user_id, amount, screenshot_path=None, days=30, **fields):
+    order = {
+        "order_id": order_id,
+        "user_id": user_id,
+        "amount": amount,
+        "days": days,
+        "screenshot_path": screenshot_path,
+        "status": "PENDING_APPROVAL",
+        "created_at": datetime.now()
+    }
+    order.update(fields)
+    await _db().orders.insert_one(order)
+    await bump_daily_stat("orders_created", order["created_at"])
+    return order
+
+async def attach_screenshot(order_id, screenshot):
+    result = await _db().orders.update_one(
+        {"order_id": order_id, "status": "AWAITING_PAYMENT"},
+        {"$set": {"status": "PENDING_APPROVAL", **screenshot}}
+    )
+    return result.modified_count > 0
+
+# --- Analytics Operations ---
+async def bump_daily_stat(field, when, count=1):
+    await _db().daily_stats.update_one({"_id": when.date().isoformat()}, {"$inc": {field: count}}, upsert=True)
@@ -0,0 +1,214 @@
+import asyncio
+import itertools
+import json
+import os
+import socket
+import threading
+import time
+from collections import deque
+from datetime import datetime
+import httpx
+import config
+import database as db
+
+# Broadcasts run on one background event loop per process. The send rate is limited in
+# Mongo (database.reserve_send_slot), so all gunicorn workers and all broadcasts together stay
+# under BROADCAST_RATE, and a broadcast is claimed in Mongo before it runs, so a resume that
+# lands on another worker can't start a second copy.
+
+API_URL = f"https://api.telegram.org/bot{config.BOT_TOKEN}/"
+MAX_ATTEMPTS = 5
+PROGRESS_EVERY = 2.0 # Seconds between progress writes (they double as the heartbeat)
+STALE_AFTER = 300 # Seconds without a heartbeat before a "running" broadcast may be resumed elsewhere
+
+class SharedRateLimiter:
+    """Async limiter on a send-slot counter in Mongo, shared by every process.
+    pause() holds every sender back, e.g. after a 429 retry_after."""
+
+    def __init__(self, name, rate):
+        self.name = name
+        self.interval = 1.0 / rate
+
+    async def acquire(self):
+        slot = await asyncio.to_thread(db.reserve_send_slot, self.name, self.interval)
+        wait = slot - time.time()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def pause(self, seconds):
+        await asyncio.to_thread(db.delay_send_slots, self.name, time.time() + seconds)
+
+_loop = None
+_limiter = SharedRateLimiter("broadcast_rate", config.BROADCAST_RATE)
+_loop_lock = threading.Lock()
+
+def _get_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, daemon=True, name="broadcaster").start()
+        return _loop
+
+def start(broadcast_id):
+    """Claims a queued/interrupted broadcast and runs it in this process. Returns False if it
+    is finished or running somewhere else."""
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    if not db.claim_broadcast(broadcast_id, owner, STALE_AFTER):
+        return False
+    asyncio.run_coroutine_threadsafe(run_broadcast(broadcast_id), _get_loop())
+    return True
+
+def is_active(broadcast):
+    heartbeat = broadcast.get("heartbeat_at")
+    return (broadcast["status"] == "running" and heartbeat is not None
+            and (datetime.now() - heartbeat).total_seconds() < STALE_AFTER)
+
+async def send(client, method, payload, files=None, last_sent=None):
+    """Sends one request honouring the global bucket, the per-chat interval and 429 retry_after."""
+    chat_id = payload.get("chat_id")
+    for attempt in range(MAX_ATTEMPTS):
+        if last_sent is not None and chat_id in last_sent:
+            wait = last_sent[chat_id] + config.BROADCAST_PER_CHAT_INTERVAL - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+        await _limiter.acquire()
+        if last_sent is not None:
+            last_sent[chat_id] = time.monotonic()
+        try:
+            if files:
+                for f in files.values():
+                    f.seek(0)
+            response = await client.post(method, data=payload, files=files)
+        except httpx.HTTPError as e:
+            print(f"⚠️ Broadcast network error for {chat_id} (attempt {attempt+1}/{MAX_ATTEMPTS}): {e}")
+            await asyncio.sleep(2 ** attempt)
+            continue
+
+        if response.status_code == 429:
+            retry_after = response.json().get("parameters", {}).get("retry_after", 5)
+            await _limiter.pause(retry_after)
+            continue
+        if response.status_code >= 500:
+            await asyncio.sleep(2 ** attempt)
+            continue
+        return response
+    return None
+
+RECIPIENT_BATCH = 500
+
+def _next_batch(cursor):
+    return list(itertools.islice(cursor, RECIPIENT_BATCH))
+
+async def _recipients(broadcast):
+    # Streams the audience from a batched Mongo cursor, so only one batch is ever in memory.
+    # Resume support: recipients come in user_id order, starting after the saved cursor.
+    cursor = db.iter_broadcast_targets(broadcast["target"], broadcast["cursor"], batch_size=RECIPIENT_BATCH)
+    try:
+        while True:
+            batch = await asyncio.to_thread(_next_batch, cursor)
+            if not batch:
+                return
+            for doc in batch:
+                yield doc["user_id"]
+    finally:
+        cursor.close()
+
+def _payload(broadcast, chat_id):
+    payload = {"chat_id": chat_id, "parse_mode": "Markdown"}
+    if broadcast.get("reply_markup"):
+        payload["reply_markup"] = json.dumps(broadcast["reply_markup"])
+    if broadcast.get("message"):
+        payload["caption" if broadcast.get("media_type") else "text"] = broadcast["message"]
+    return payload
+
+async def run_broadcast(broadcast_id):
+    broadcast = db.get_broadcast(broadcast_id)
+    started = time.monotonic()
+    stats = {"sent": broadcast["sent"], "failed": broadcast["failed"]}
+    sent_before = stats["sent"] + stats["failed"]
+
+    m_type = broadcast.get("media_type")
+    method = {"photo": "sendPhoto", "video": "sendVideo"}.get(m_type, "sendMessage")
+
+    # Completion order differs from dispatch order; the cursor only moves past a user once
+    # everyone dispatched before them is done, so a resume never skips anybody.
+    dispatched = deque()
+    done = set()
+    last_saved = time.monotonic()
+
+    def record(user_id, ok):
+        nonlocal last_saved
+        stats["sent" if ok else "failed"] += 1
+        done.add(user_id)
+        while dispatched and dispatched[0] in done:
+            done.discard(dispatched[0])
+            broadcast["cursor"] = dispatched.popleft()
+        if time.monotonic() - last_saved > PROGRESS_EVERY:
+            last_saved = time.monotonic()
+            db.update_broadcast(broadcast_id, {"cursor": broadcast["cursor"], "heartbeat_at": datetime.now(), **stats})
+
+    limits = httpx.Limits(max_connections=config.BROADCAST_CONCURRENCY, max_keepalive_connections=config.BROADCAST_CONCURRENCY)
+    try:
+        async with httpx.AsyncClient(base_url=API_URL, timeout=30, limits=limits) as client:
+            recipients = _recipients(broadcast)
+            file_id = broadcast.get("file_id")
+
+            # Media: upload once to the first recipient, then everyone gets the file_id
+            if m_type and not file_id:
+                async for user_id in recipients:
+                    dispatched.append(user_id)
+                    with open(broadcast["media_path"], 'rb') as f:
+                        response = await send(client, method, _payload(broadcast, user_id), files={m_type: f})
+                    ok = response is not None and response.status_code == 200
+                    record(user_id, ok)
+                    if ok:
+                        result = response.json()["result"]
+                        file_id = result["photo"][-1]["file_id"] if m_type == "photo" else result["video"]["file_id"]
+                        db.update_broadcast(broadcast_id, {"file_id": file_id})
+                        break
+
+            queue = asyncio.Queue(maxsize=config.BROADCAST_CONCURRENCY * 2)
+            last_sent = {}
+
+            async def worker():
+                while True:
+                    user_id = await queue.get()
+                    if user_id is None:
+                        return
+                    payload = _payload(broadcast, user_id)
+                    if m_type:
+                        payload[m_type] = file_id
+                    try:
+                        response = await send(client, method, payload, last_sent=last_sent)
+                        record(user_id, response is not None and response.status_code == 200)
+                    except Exception as e:
+                        print(f"Broadcast error for {user_id}: {e}")
+                        record(user_id, False)
+
+            workers = [asyncio.create_task(worker()) for _ in range(config.BROADCAST_CONCURRENCY)]
+            async for user_id in recipients:
+                dispatched.append(user_id)
+                await queue.put(user_id)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+
+        elapsed = time.monotonic() - started
+        rate = (stats["sent"] + stats["failed"] - sent_before) / elapsed if elapsed else 0
+        db.update_broadcast(broadcast_id, {
+            "status": "done",
+            "cursor": broadcast["cursor"],
+            "finished_at": datetime.now(),
+            "rate": round(rate, 2),
+            **stats
+        })
+        print(f"Broadcast completed. Sent to {stats['sent']} users ({stats['failed']} failed, {rate:.1f} msg/s).")
+
+        # Cleanup
+        media_path = broadcast.get("media_path")
+        if media_path and os.path.exists(media_path):
+            os.remove(media_path)
+    except Exception as e:
+        print(f"⚠️ Broadcast {broadcast_id} interrupted: {e}")
+        db.update_broadcast(broadcast_id, {"status": "interrupted", "cursor": broadcast["cursor"], **stats})
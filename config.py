@@ -9,14 +9,43 @@ ADMIN_ID = int(os.getenv("ADMIN_ID", 0))
 # Channel Configuration
 PRIVATE_CHANNEL_ID = os.getenv("PRIVATE_CHANNEL_ID")
 CHANNEL_START_ID = int(os.getenv("CHANNEL_START_ID", 1)) # Message ID of the first video
+BACKFILL_PROBE_INTERVAL = float(os.getenv("BACKFILL_PROBE_INTERVAL", 1.0)) # Seconds between /backfill probes (each is a copy + delete)
+
+# Update Delivery
+BOT_MODE = os.getenv("BOT_MODE", "polling") # "polling" or "webhook"
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", 64)) # Updates handled in parallel (one at a time per user)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL") # Public https base URL Telegram posts to, e.g. https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8443))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") # Sent back by Telegram in X-Telegram-Bot-Api-Secret-Token
 
 # Config
 QR_CODE_PATH = "qr.jpeg" # Place a file named qr.jpeg in the bot folder
 UPLOAD_FOLDER = "static/screenshots"
+SCREENSHOT_THUMB_SIZE = int(os.getenv("SCREENSHOT_THUMB_SIZE", 160)) # Max px of the dashboard thumbnails
+SCREENSHOT_MATCH_DISTANCE = min(int(os.getenv("SCREENSHOT_MATCH_DISTANCE", 6)), 7) # Max differing dHash bits (of 64) to call two screenshots the same; the banded index finds up to 7
+SCREENSHOT_MAX_MATCHES = 5 # Similar earlier orders listed on a new order
+SCREENSHOT_RETENTION_DAYS = int(os.getenv("SCREENSHOT_RETENTION_DAYS", 90)) # Files of settled orders older than this are deleted
+PENDING_PAYMENT_TTL = int(os.getenv("PENDING_PAYMENT_TTL", 24 * 3600)) # Seconds a chosen plan waits for its screenshot
 
 # MongoDB
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017/")
 DB_NAME = "tele_corn_bot"
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", 50)) # Connections per client, i.e. per process (bot, each web worker)
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", 0))
+MONGO_MAX_IDLE_MS = int(os.getenv("MONGO_MAX_IDLE_MS", 60000)) # Idle pooled connections are closed after this
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", 10000))
+MONGO_WRITE_CONCERN = os.getenv("MONGO_WRITE_CONCERN") # e.g. "majority" or "1"; unset uses the server default
+MONGO_READ_CONCERN = os.getenv("MONGO_READ_CONCERN") # e.g. "local" or "majority"; unset uses the server default
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 10000)) # Max user documents kept in memory
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", 60)) # Seconds before a cached user is re-read
+SETTINGS_REFRESH_INTERVAL = int(os.getenv("SETTINGS_REFRESH_INTERVAL", 15)) # Seconds between settings version checks
+
+# Broadcasts
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 25)) # Messages/sec, Telegram allows ~30 globally
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 20)) # Parallel in-flight requests
+BROADCAST_PER_CHAT_INTERVAL = 1.0 # Seconds between two messages to the same chat
 
 # Paytm Credentials
 PAYTM_MID = os.getenv("PAYTM_MID")
@@ -25,8 +54,24 @@ PAYTM_WEBSITE = os.getenv("PAYTM_WEBSITE", "DEFAULT")
 PAYTM_CALLBACK_URL = os.getenv("PAYTM_CALLBACK_URL", "https://securegw.paytm.in/theia/paytmCallback") # Not used for bot usually, but required params
 PAYTM_INDUSTRY_TYPE_ID = os.getenv("PAYTM_INDUSTRY_TYPE_ID", "Retail")
 PAYTM_CHANNEL_ID = os.getenv("PAYTM_CHANNEL_ID", "WAP")
-PAYTM_TRANSACTION_URL = "https://securegw.paytm.in/theia/processTransaction"
-PAYTM_STATUS_URL = "https://securegw.paytm.in/merchant-status/getTxnStatus"
+PAYTM_TRANSACTION_URL = os.getenv("PAYTM_TRANSACTION_URL", "https://securegw.paytm.in/theia/processTransaction")
+PAYTM_STATUS_URL = os.getenv("PAYTM_STATUS_URL", "https://securegw.paytm.in/merchant-status/getTxnStatus")
+PAYTM_TIMEOUT = float(os.getenv("PAYTM_TIMEOUT", 10)) # Seconds per request
+PAYTM_RETRIES = int(os.getenv("PAYTM_RETRIES", 2)) # Extra attempts on connection errors / 429 / 5xx
+PAYTM_POOL_SIZE = int(os.getenv("PAYTM_POOL_SIZE", 10)) # Keep-alive connections to the gateway
+PAYTM_RECONCILE_INTERVAL = int(os.getenv("PAYTM_RECONCILE_INTERVAL", 120)) # Seconds between status sweeps of pending orders
+PAYTM_RECONCILE_CONCURRENCY = int(os.getenv("PAYTM_RECONCILE_CONCURRENCY", 8)) # Status checks in flight at once
+PAYTM_RECONCILE_MAX_AGE = int(os.getenv("PAYTM_RECONCILE_MAX_AGE", 48 * 3600)) # Older pending orders are left to the admin
+PAYTM_PAYMENT_PAGE_URL = os.getenv("PAYTM_PAYMENT_PAGE_URL", "https://securegw.paytm.in/theia/api/v1/showPaymentPage")
+PAYTM_SIGNING_POOL = os.getenv("PAYTM_SIGNING_POOL", "thread") # "thread" or "process"; where checksums are computed
+PAYTM_SIGNING_WORKERS = int(os.getenv("PAYTM_SIGNING_WORKERS", 2))
+PAYTM_SIGNING_CHUNK = int(os.getenv("PAYTM_SIGNING_CHUNK", 50)) # Bodies signed per pool task in a batch
+PAYTM_SIGNATURE_CACHE_SIZE = int(os.getenv("PAYTM_SIGNATURE_CACHE_SIZE", 10000)) # Memoized status requests (per order)
+
+# Payments
+PAYMENT_MODE = os.getenv("PAYMENT_MODE", "manual") # "manual": QR + screenshot review, "auto": Paytm checkout, screenshot as fallback
+PAYMENT_PORT = int(os.getenv("PAYMENT_PORT", 5051)) # Port of server.payments_app, the only public part of server.py
+PAYMENT_PAGE_BASE_URL = os.getenv("PAYMENT_PAGE_BASE_URL", f"http://localhost:{PAYMENT_PORT}") # Public URL of server.payments_app, hosts /pay/<order_id>
 
 
 # Subscription Plans
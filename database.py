@@ -1,152 +1,379 @@
-import json
+import base64
+import bisect
 import os
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
 import pymongo
+from pymongo import monitoring
+from bson import json_util
 import config
 
-client = pymongo.MongoClient(config.MONGO_URI)
-db = client[config.DB_NAME]
+# --- Connection ---
+# The client is created on first use, not at import, and again in any process that has
+# forked since (gunicorn workers, for instance): a MongoClient must not cross a fork.
+class PoolStats(monitoring.ConnectionPoolListener):
+    """Counts what a client's connection pools are doing, for sizing MONGO_MAX_POOL_SIZE."""
 
-users_col = db["users"]
-videos_col = db["videos"]
-orders_col = db["orders"]
-payouts_col = db["payouts"]
-settings_col = db["settings"]
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {"open": 0, "in_use": 0, "peak_in_use": 0, "created": 0, "checkouts": 0,
+                       "checkout_failures": 0, "wait_total": 0.0, "wait_max": 0.0, "cleared": 0}
 
-def migrate_from_json():
-    db_file = "db.json"
-    if not os.path.exists(db_file): return
-    try:
-        with open(db_file, "r") as f:
-            data = json.load(f)
-            
-        if "users" in data and users_col.count_documents({}) == 0:
-            users_list = list(data["users"].values())
-            if users_list: users_col.insert_many(users_list)
-            
-        if "videos" in data and videos_col.count_documents({}) == 0:
-            if data["videos"]: videos_col.insert_many(data["videos"])
-            
-        if "orders" in data and orders_col.count_documents({}) == 0:
-            orders_list = list(data["orders"].values())
-            if orders_list: orders_col.insert_many(orders_list)
-            
-        if "payouts" in data and payouts_col.count_documents({}) == 0:
-            if data["payouts"]: payouts_col.insert_many(data["payouts"])
-            
-        os.rename(db_file, "db_migrated.json")
-    except Exception as e:
-        print(f"Migration error: {e}")
+    def _update(self, **changes):
+        with self._lock:
+            for key, value in changes.items():
+                self._stats[key] += value
+            self._stats["peak_in_use"] = max(self._stats["peak_in_use"], self._stats["in_use"])
+
+    def _waited(self, event):
+        duration = getattr(event, "duration", 0) or 0
+        with self._lock:
+            self._stats["wait_total"] += duration
+            self._stats["wait_max"] = max(self._stats["wait_max"], duration)
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["wait_avg"] = stats["wait_total"] / stats["checkouts"] if stats["checkouts"] else 0.0
+        return stats
+
+    def pool_created(self, event): pass
+    def pool_ready(self, event): pass
+    def pool_cleared(self, event): self._update(cleared=1)
+    def pool_closed(self, event): pass
+    def connection_created(self, event): self._update(open=1, created=1)
+    def connection_ready(self, event): pass
+    def connection_closed(self, event): self._update(open=-1)
+    def connection_check_out_started(self, event): pass
+    def connection_check_out_failed(self, event):
+        self._update(checkout_failures=1)
+        self._waited(event)
+    def connection_checked_out(self, event):
+        self._update(in_use=1, checkouts=1)
+        self._waited(event)
+    def connection_checked_in(self, event): self._update(in_use=-1)
+
+def client_options(listener=None):
+    """Pool and concern settings shared by the sync client and async_database's client."""
+    options = {
+        "maxPoolSize": config.MONGO_MAX_POOL_SIZE,
+        "minPoolSize": config.MONGO_MIN_POOL_SIZE,
+        "maxIdleTimeMS": config.MONGO_MAX_IDLE_MS,
+        "serverSelectionTimeoutMS": config.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+    }
+    if config.MONGO_WRITE_CONCERN:
+        w = config.MONGO_WRITE_CONCERN
+        options["w"] = int(w) if w.isdigit() else w
+    if config.MONGO_READ_CONCERN:
+        options["readConcernLevel"] = config.MONGO_READ_CONCERN
+    if listener:
+        options["event_listeners"] = [listener]
+    return options
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+_pool_stats = None
+
+def get_client():
+    global _client, _client_pid, _pool_stats
+    if _client is None or _client_pid != os.getpid():
+        with _client_lock:
+            if _client is None or _client_pid != os.getpid():
+                # After a fork the parent's client is simply dropped: closing it here would
+                # also close sockets the parent is still using
+                _pool_stats = PoolStats()
+                _client = pymongo.MongoClient(config.MONGO_URI, **client_options(_pool_stats))
+                _client_pid = os.getpid()
+    return _client
+
+def get_db():
+    return get_client()[config.DB_NAME]
+
+def pool_stats():
+    """Connection pool counters for this process's client (empty until it is first used)."""
+    return {
+        "pid": os.getpid(),
+        "max_pool_size": config.MONGO_MAX_POOL_SIZE,
+        **(_pool_stats.snapshot() if _pool_stats and _client_pid == os.getpid() else {})
+    }
+
+class _LazyCollection:
+    # Stands in for a Collection so the *_col names below can stay module globals
+    def __init__(self, name):
+        self._name = name
 
-migrate_from_json()
+    def __getattr__(self, attr):
+        return getattr(get_db()[self._name], attr)
+
+users_col = _LazyCollection("users")
+videos_col = _LazyCollection("videos")
+orders_col = _LazyCollection("orders")
+payouts_col = _LazyCollection("payouts")
+settings_col = _LazyCollection("settings")
+media_col = _LazyCollection("media")
+broadcasts_col = _LazyCollection("broadcasts")
+pending_payments_col = _LazyCollection("pending_payments")
+ledger_col = _LazyCollection("ledger")
+daily_stats_col = _LazyCollection("daily_stats")
+counters_col = _LazyCollection("counters")
+screenshot_hashes_col = _LazyCollection("screenshot_hashes")
+
+_transactions = None
+
+def run_in_transaction(callback):
+    """Runs callback(session) in a transaction on replica sets / sharded clusters, and
+    directly (session=None) on a standalone server, which can't do transactions."""
+    global _transactions
+    if _transactions is None:
+        hello = get_client().admin.command("hello")
+        _transactions = "setName" in hello or hello.get("msg") == "isdbgrid"
+    if not _transactions:
+        return callback(None)
+    with get_client().start_session() as session:
+        return session.with_transaction(callback)
+
+# --- Counters ---
+def next_sequence(name):
+    """Atomically hands out 1, 2, 3... per name; concurrent callers never get the same value."""
+    counter = counters_col.find_one_and_update(
+        {"_id": name}, {"$inc": {"seq": 1}}, upsert=True, return_document=pymongo.ReturnDocument.AFTER
+    )
+    return counter["seq"]
 
 # --- Settings Operations ---
+# Settings are loaded once per process and served from memory. Writers bump a version
+# counter in the settings collection; readers call refresh_settings() (the bot does it
+# from a job) to reload only when some process changed something.
+DEFAULT_PRICING_PLANS = {
+    "1-Day": {"price": 49, "days": 1, "minutes": 0, "description": "Access for 1 Day"},
+    "1-Week": {"price": 99, "days": 7, "minutes": 0, "description": "Access for 7 Days"},
+    "1-Month": {"price": 199, "days": 30, "minutes": 0, "description": "Access for 30 Days"},
+    "3-Months": {"price": 299, "days": 90, "minutes": 0, "description": "Access for 90 Days"},
+    "6-Months": {"price": 399, "days": 180, "minutes": 0, "description": "Access for 180 Days"},
+    "Lifetime": {"price": 699, "days": 36500, "minutes": 0, "description": "Lifetime Access"},
+    "Demo": {"price": 0, "url": "https://t.me/+r5WU9e69M8xjY2Zl", "description": "Join Free Channel"}
+}
+SETTINGS_KEYS = ["main_menu", "pricing_plans", "version"]
+
+_settings = None
+_settings_version = None
+
+def _load_settings():
+    global _settings, _settings_version
+    docs = {d["_id"]: d for d in settings_col.find({"_id": {"$in": SETTINGS_KEYS}})}
+    _settings = docs
+    _settings_version = docs.get("version", {}).get("v", 0)
+
+def _get_setting(key):
+    if _settings is None:
+        _load_settings()
+    return _settings.get(key)
+
+def _settings_changed():
+    global _settings
+    settings_col.update_one({"_id": "version"}, {"$inc": {"v": 1}}, upsert=True)
+    _settings = None
+
+def refresh_settings():
+    """Reloads cached settings if another process changed them. Returns True on reload."""
+    doc = settings_col.find_one({"_id": "version"})
+    version = doc["v"] if doc else 0
+    if _settings is None or version != _settings_version:
+        _load_settings()
+        return True
+    return False
+
 def get_main_menu_text():
-    setting = settings_col.find_one({"_id": "main_menu"})
+    setting = _get_setting("main_menu")
     if setting and "text" in setting:
         return setting["text"]
     return None
 
 def update_main_menu_text(text):
     settings_col.update_one({"_id": "main_menu"}, {"$set": {"text": text}}, upsert=True)
+    _settings_changed()
 
 def get_pricing_plans():
-    setting = settings_col.find_one({"_id": "pricing_plans"})
+    setting = _get_setting("pricing_plans")
     if setting and "plans" in setting:
         return setting["plans"]
     
     # Default config plans if not set in DB
-    default_plans = {
-        "1-Day": {"price": 49, "days": 1, "minutes": 0, "description": "Access for 1 Day"},
-        "1-Week": {"price": 99, "days": 7, "minutes": 0, "description": "Access for 7 Days"},
-        "1-Month": {"price": 199, "days": 30, "minutes": 0, "description": "Access for 30 Days"},
-        "3-Months": {"price": 299, "days": 90, "minutes": 0, "description": "Access for 90 Days"},
-        "6-Months": {"price": 399, "days": 180, "minutes": 0, "description": "Access for 180 Days"},
-        "Lifetime": {"price": 699, "days": 36500, "minutes": 0, "description": "Lifetime Access"},
-        "Demo": {"price": 0, "url": "https://t.me/+r5WU9e69M8xjY2Zl", "description": "Join Free Channel"}
-    }
-    update_pricing_plans(default_plans)
-    return default_plans
+    return DEFAULT_PRICING_PLANS
 
 def update_pricing_plans(plans_dict):
     settings_col.update_one({"_id": "pricing_plans"}, {"$set": {"plans": plans_dict}}, upsert=True)
+    _settings_changed()
 
-# --- User Operations ---
-def get_user(user_id):
-    user_id_str = str(user_id)
-    user = users_col.find_one({"user_id": int(user_id_str)}) or users_col.find_one({"user_id": user_id_str})
-    
-    if not user:
-        user = {
-            "user_id": int(user_id_str),
-            "is_subscribed": False,
-            "subscription_expiry": None,
-            "current_video_index": 0,
-            "last_message_id": None,
-            "demo_used": False,
-            "joined_at": datetime.now().isoformat()
-        }
-        users_col.insert_one(user)
-    else:
-        # Check expiry
-        if user.get("is_subscribed") and user.get("subscription_expiry"):
-            expiry = datetime.fromisoformat(user["subscription_expiry"]) if isinstance(user["subscription_expiry"], str) else user["subscription_expiry"]
-            if expiry < datetime.now():
-                users_col.update_one({"_id": user["_id"]}, {"$set": {"is_subscribed": False}})
-                user["is_subscribed"] = False
-    return user
+# --- Media Operations ---
+# Telegram file_ids of images we already uploaded, keyed by path + content hash
+def get_media_file_id(path, digest):
+    media = media_col.find_one({"_id": f"{path}:{digest}"})
+    return media["file_id"] if media else None
+
+def save_media_file_id(path, digest, file_id):
+    media_col.update_one(
+        {"_id": f"{path}:{digest}"},
+        {"$set": {"path": path, "sha256": digest, "file_id": file_id, "updated_at": datetime.now()}},
+        upsert=True
+    )
+
+def invalidate_media(path):
+    media_col.delete_many({"path": path})
+
+# --- User Cache ---
+# Bounded LRU of user documents with a TTL. Every writer below writes through it, so the
+# bot can serve navigation taps without reading Mongo. Other processes (the dashboard)
+# don't see it; the TTL bounds how long their changes can go unnoticed.
+_user_cache = OrderedDict()
+_user_cache_lock = threading.Lock()
 
-def mark_demo_used(user_id):
-    users_col.update_one({"user_id": int(user_id)}, {"$set": {"demo_used": True}})
+def get_cached_user(user_id):
+    with _user_cache_lock:
+        entry = _user_cache.get(user_id)
+        if entry is None:
+            return None
+        stored_at, user = entry
+        if time.monotonic() - stored_at > config.USER_CACHE_TTL:
+            del _user_cache[user_id]
+            return None
+        _user_cache.move_to_end(user_id)
+        return user
+
+def cache_user(user):
+    with _user_cache_lock:
+        _user_cache[user["user_id"]] = (time.monotonic(), user)
+        _user_cache.move_to_end(user["user_id"])
+        while len(_user_cache) > config.USER_CACHE_SIZE:
+            _user_cache.popitem(last=False)
+
+def update_cached_user(user_id, fields):
+    with _user_cache_lock:
+        entry = _user_cache.get(int(user_id))
+        if entry:
+            entry[1].update(fields)
+
+def invalidate_user(user_id):
+    with _user_cache_lock:
+        _user_cache.pop(int(user_id), None)
+
+def expire_cached_users(now):
+    with _user_cache_lock:
+        for _, user in _user_cache.values():
+            expiry = user.get("subscription_expiry")
+            if isinstance(expiry, datetime) and expiry < now:
+                user.update({"is_subscribed": False, "last_message_id": None})
+
+def new_user_fields(now):
+    return {
+        "is_subscribed": False,
+        "subscription_expiry": None,
+        "current_video_index": 0,
+        "last_message_id": None,
+        "demo_used": False,
+        "joined_at": now
+    }
 
+def with_subscription_state(user, now):
+    # Check expiry (the expiry job persists the flag, here we only report it)
+    user = dict(user)
+    expiry = user.get("subscription_expiry")
+    if user.get("is_subscribed") and (not isinstance(expiry, datetime) or expiry < now):
+        user["is_subscribed"] = False
+    return user
+
+# --- User Operations ---
 def update_last_message_id(user_id, message_id):
     users_col.update_one({"user_id": int(user_id)}, {"$set": {"last_message_id": message_id}})
+    update_cached_user(user_id, {"last_message_id": message_id})
 
-def update_user_subscription(user_id, days=0, minutes=0):
-    expiry = datetime.now() + timedelta(days=days, minutes=minutes)
-    users_col.update_one(
-        {"user_id": int(user_id)},
-        {"$set": {
-            "is_subscribed": True,
-            "subscription_expiry": expiry.isoformat()
-        }}
-    )
+def subscription_extension(now, days=0, minutes=0):
+    """Update pipeline that stacks a plan onto the remaining time: max(now, expiry) + duration.
+    `now` is passed in rather than $$NOW because stored dates are naive local time, $$NOW is UTC."""
+    duration_ms = int(timedelta(days=days, minutes=minutes).total_seconds() * 1000)
+    return [{"$set": {
+        "is_subscribed": True,
+        "subscription_expiry": {"$add": [{"$max": [now, "$subscription_expiry"]}, duration_ms]}
+    }}]
 
 def update_video_index(user_id, index):
     users_col.update_one({"user_id": int(user_id)}, {"$set": {"current_video_index": index}})
+    update_cached_user(user_id, {"current_video_index": index})
 
 # --- Video Operations ---
+# The videos collection indexes copyable message ids of PRIVATE_CHANNEL_ID. The bot keeps the
+# sorted ids in memory so Next/Prev is a bisect instead of probing the channel with copy_message.
+_video_ids = None
+
+def get_video_ids():
+    global _video_ids
+    if _video_ids is None:
+        _video_ids = sorted(v["message_id"] for v in videos_col.find({"message_id": {"$ne": None}}, {"message_id": 1}))
+    return _video_ids
+
 def add_video(file_id, description, message_id=None):
-    seq_id = videos_col.count_documents({})
     video = {
         "file_id": file_id,
         "description": description,
-        "message_id": message_id,
-        "sequence_id": seq_id
+        "message_id": message_id
     }
-    videos_col.insert_one(video)
+    # sequence_id stays 0-based like before; the counter hands out 1, 2, 3...
+    if message_id is None:
+        video["sequence_id"] = next_sequence("videos") - 1
+        videos_col.insert_one(video)
+        return video
+
+    videos_col.update_one(
+        {"message_id": message_id},
+        {"$set": video, "$setOnInsert": {"sequence_id": next_sequence("videos") - 1}},
+        upsert=True
+    )
+    ids = get_video_ids()
+    i = bisect.bisect_left(ids, message_id)
+    if i == len(ids) or ids[i] != message_id:
+        ids.insert(i, message_id)
     return video
 
+def remove_video(message_id):
+    videos_col.delete_one({"message_id": message_id})
+    ids = get_video_ids()
+    i = bisect.bisect_left(ids, message_id)
+    if i < len(ids) and ids[i] == message_id:
+        del ids[i]
+
+def resolve_video_id(message_id):
+    """First indexed id >= message_id, wrapping to the first one. None if nothing is indexed."""
+    ids = get_video_ids()
+    if not ids:
+        return None
+    i = bisect.bisect_left(ids, message_id)
+    return ids[i] if i < len(ids) else ids[0]
+
+def get_prev_video_id(message_id):
+    """Last indexed id < message_id (stays on the first one). None if nothing is indexed."""
+    ids = get_video_ids()
+    if not ids:
+        return None
+    i = bisect.bisect_left(ids, message_id)
+    return ids[i - 1] if i > 0 else ids[0]
+
 def get_video_by_index(index):
     return videos_col.find_one({"sequence_id": index})
 
 def get_total_videos():
     return videos_col.count_documents({})
 
-# --- Order Operations ---
-def create_order(order_id, user_id, amount, screenshot_path=None, days=30):
-    order = {
-        "order_id": order_id,
-        "user_id": user_id,
-        "amount": amount,
-        "days": days,
-        "screenshot_path": screenshot_path,
-        "status": "PENDING_APPROVAL",
-        "created_at": datetime.now().isoformat()
-    }
-    orders_col.insert_one(order)
-    return order
+# --- Pending Payment Operations ---
+# Plan a user picked and is expected to pay for, keyed by user_id. A TTL index on created_at
+# drops abandoned intents; created_at is UTC because that's what the TTL monitor compares with.
+# The bot sets and reads them through async_database; here they are only cleared.
+def clear_pending_payment(user_id):
+    pending_payments_col.delete_one({"_id": int(user_id)})
 
+# --- Order Operations ---
 def update_order_status(order_id, status):
     orders_col.update_one({"order_id": order_id}, {"$set": {"status": status}})
 
@@ -160,111 +387,366 @@ def get_all_users():
 def get_pending_orders():
     return list(orders_col.find({"status": "PENDING_APPROVAL"}))
 
-def approve_order(order_id):
-    order = orders_col.find_one({"order_id": order_id})
-    if order:
-        if order.get("status") == "SUCCESS":
-            return False # Already approved
-            
-        orders_col.update_one({"_id": order["_id"]}, {"$set": {"status": "SUCCESS"}})
-        
-        user_id = int(order["user_id"])
-        days = order.get("days", 30) 
-        
-        user = users_col.find_one({"user_id": user_id})
-        expiry = datetime.now() + timedelta(days=days)
-        
+def get_pending_orders_since(since):
+    # Gateway orders nobody has paid yet and screenshot orders waiting for the admin
+    query = {"status": {"$in": ["AWAITING_PAYMENT", "PENDING_APPROVAL"]}, "created_at": {"$gte": since}}
+    return list(orders_col.find(query, {"_id": 0}))
+
+def find_order_by_screenshot(digest):
+    # The first order that used this exact image
+    return orders_col.find_one({"screenshot_sha256": digest}, {"_id": 0, "order_id": 1}, sort=[("created_at", 1)])
+
+def find_screenshot_candidates(bands, limit=500):
+    # Common bands (plain backgrounds) can match many screenshots; those sharing the most bands
+    # are the closest, so the cap drops the least likely candidates
+    return list(screenshot_hashes_col.aggregate([
+        {"$match": {"bands": {"$in": bands}}},
+        {"$project": {"user_id": 1, "phash": 1, "shared": {"$size": {"$setIntersection": ["$bands", bands]}}}},
+        {"$sort": {"shared": -1}},
+        {"$limit": limit}
+    ]))
+
+def save_screenshot_hash(order_id, user_id, phash, bands, created_at):
+    screenshot_hashes_col.update_one(
+        {"_id": order_id},
+        {"$set": {"user_id": user_id, "phash": phash, "bands": bands, "created_at": created_at}},
+        upsert=True
+    )
+
+def get_unhashed_screenshots():
+    query = {"screenshot_path": {"$ne": None}, "screenshot_phash": {"$exists": False}}
+    return list(orders_col.find(query, {"_id": 0, "order_id": 1, "user_id": 1, "screenshot_path": 1, "created_at": 1}))
+
+def set_order_phash(order_id, phash):
+    orders_col.update_one({"order_id": order_id}, {"$set": {"screenshot_phash": phash}})
+
+def get_expired_screenshots(cutoff):
+    query = {"created_at": {"$lt": cutoff}, "status": {"$ne": "PENDING_APPROVAL"}, "screenshot_path": {"$ne": None}}
+    return list(orders_col.find(query, {"_id": 0, "order_id": 1, "screenshot_path": 1, "screenshot_thumb": 1, "screenshot_sha256": 1}))
+
+def screenshot_in_use(digest, cutoff):
+    return orders_col.find_one({
+        "screenshot_sha256": digest,
+        "$or": [{"created_at": {"$gte": cutoff}}, {"status": "PENDING_APPROVAL"}]
+    }, {"_id": 1}) is not None
+
+def clear_screenshots(order_ids):
+    # The hash stays, so a purged image is still recognised if it is sent again
+    if order_ids:
+        orders_col.update_many(
+            {"order_id": {"$in": order_ids}},
+            {"$set": {"screenshot_path": None, "screenshot_thumb": None, "screenshot_purged_at": datetime.now()}}
+        )
+
+def fail_order(order_id):
+    # Only unpaid gateway orders; a screenshot order stays with the admin whatever Paytm says
+    orders_col.update_one({"order_id": order_id, "status": "AWAITING_PAYMENT"}, {"$set": {"status": "FAILED"}})
+
+# --- Dashboard Pagination ---
+# Keyset (cursor) pagination: a page resumes right after the sort key of the previous page's
+# last row, so every page is an index range scan no matter how deep the admin scrolls.
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json_util.dumps(values).encode()).decode()
+
+def decode_cursor(cursor):
+    """Raises ValueError for anything encode_cursor did not produce."""
+    try:
+        values = json_util.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {e}") from e
+    if not isinstance(values, list):
+        raise ValueError("Invalid cursor")
+    return values
+
+def _keyset_page(collection, query, sort, after=None, limit=50, projection=None):
+    # Sort keys must be non-null, except in descending order (nulls sort last there)
+    if after:
+        values = decode_cursor(after)
+        if len(values) != len(sort):
+            raise ValueError("Invalid cursor")
+        clauses = []
+        for i, (field, direction) in enumerate(sort):
+            prefix = {f: v for (f, _), v in zip(sort[:i], values[:i])}
+            clauses.append({**prefix, field: {"$gt" if direction == 1 else "$lt": values[i]}})
+            if direction == -1 and values[i] is not None:
+                # $lt never matches null, but the nulls still come after this value
+                clauses.append({**prefix, field: None})
+        query = {"$and": [query, {"$or": clauses}]}
+
+    docs = list(collection.find(query, projection).sort(sort).limit(limit + 1))
+    next_cursor = None
+    if len(docs) > limit:
+        docs = docs[:limit]
+        next_cursor = encode_cursor([docs[-1].get(field) for field, _ in sort])
+    return docs, next_cursor
+
+def list_users_page(after=None, limit=50, sort="id", user_id=None):
+    query = {"user_id": int(user_id)} if user_id else {}
+    order = [("subscription_expiry", -1), ("user_id", -1)] if sort == "expiry" else [("user_id", 1)]
+    users, next_cursor = _keyset_page(users_col, query, order, after, limit,
+                                      {"_id": 0, "user_id": 1, "is_subscribed": 1, "subscription_expiry": 1, "current_video_index": 1})
+    now = datetime.now()
+    return [with_subscription_state(u, now) for u in users], next_cursor
+
+def list_pending_orders_page(after=None, limit=50):
+    return _keyset_page(orders_col, {"status": "PENDING_APPROVAL"}, [("created_at", 1), ("order_id", 1)], after, limit, {"_id": 0})
+
+def list_payouts_page(after=None, limit=20):
+    return _keyset_page(payouts_col, {}, [("date", -1), ("id", -1)], after, limit, {"_id": 0})
+
+def approve_order(order_id, via="admin"):
+    """Approves an order exactly once. Returns the approved order, or None if it is missing or
+    was already approved (double clicks, two admins, admin and gateway racing).
+    via ("admin" or "gateway") is the path that granted access, for time-to-access stats."""
+    def approve(session):
+        # The status condition makes the flip itself the idempotency check
+        approved_at = datetime.now()
+        order = orders_col.find_one_and_update(
+            {"order_id": order_id, "status": {"$ne": "SUCCESS"}},
+            {"$set": {"status": "SUCCESS", "approved_at": approved_at, "approved_via": via}},
+            return_document=pymongo.ReturnDocument.AFTER,
+            session=session
+        )
+        if not order:
+            return None, None
+
+        days = order.get("days", 30)
+        user = users_col.find_one_and_update(
+            {"user_id": int(order["user_id"])},
+            subscription_extension(approved_at, days),
+            return_document=pymongo.ReturnDocument.AFTER,
+            session=session
+        )
         if not user:
-             users_col.insert_one({
-                "user_id": user_id,
+            # Orders always come from users who pressed /start, this is just a safety net
+            user = {
+                "user_id": int(order["user_id"]),
+                **new_user_fields(approved_at),
                 "is_subscribed": True,
-                "subscription_expiry": expiry.isoformat(),
-                "current_video_index": 0,
-                "joined_at": datetime.now().isoformat()
-            })
-        else:
-            users_col.update_one(
-                {"_id": user["_id"]},
-                {"$set": {
-                    "is_subscribed": True,
-                    "subscription_expiry": expiry.isoformat()
-                }}
-            )
-        return True
-    return False
+                "subscription_expiry": approved_at + timedelta(days=days)
+            }
+            users_col.insert_one(user, session=session)
+        record_earning(order["amount"], order.get("created_at"), session=session)
+        counts = {"orders_approved": 1}
+        started_at = order.get("started_at") or order.get("created_at")
+        if isinstance(started_at, datetime):
+            counts[f"approved_{via}"] = 1
+            counts[f"access_seconds_{via}"] = (approved_at - started_at).total_seconds()
+        bump_daily_stats(counts, approved_at, session=session)
+        return order, user
+
+    order, user = run_in_transaction(approve)
+    if user:
+        cache_user(user)
+    return order
 
 def reject_order(order_id):
     result = orders_col.update_one({"order_id": order_id}, {"$set": {"status": "REJECTED"}})
     return result.modified_count > 0
 
 def expire_user(user_id):
-    result = users_col.update_one(
-        {"user_id": int(user_id)},
-        {"$set": {
-            "is_subscribed": False,
-            "subscription_expiry": None
-        }}
-    )
+    # Expiry is set to "now" (not None) so the expiry job picks the user up and vanishes their video
+    fields = {"is_subscribed": False, "subscription_expiry": datetime.now()}
+    result = users_col.update_one({"user_id": int(user_id)}, {"$set": fields})
+    update_cached_user(user_id, fields)
     return result.modified_count > 0
 
 def get_earnings_stats():
-    orders = list(orders_col.find({"status": "SUCCESS"}))
-    
-    total_earnings = 0
-    daily_earnings = 0
-    today_str = datetime.now().date().isoformat()
-    
-    for order in orders:
-        try:
-            amount = float(order["amount"])
-            total_earnings += amount
-            
-            created_at = order.get("created_at", "")
-            if created_at.startswith(today_str):
-                daily_earnings += amount
-        except (ValueError, TypeError):
-            pass
-            
+    today = _day_key(None)
+    docs = {d["_id"]: d for d in ledger_col.find({"_id": {"$in": ["totals", today]}})}
     return {
-        "total": total_earnings,
-        "daily": daily_earnings
+        "total": docs.get("totals", {}).get("earnings", 0),
+        "daily": docs.get(today, {}).get("earnings", 0),
+        "paid": docs.get("totals", {}).get("paid", 0)
     }
 
-def get_daily_user_analytics():
-    # Group users by joined_at date snippet (YYYY-MM-DD)
-    users = list(users_col.find({}, {"joined_at": 1}))
-    analytics = {}
-    
-    for u in users:
-        # Default to old users if they don't have joined_at (from migration)
-        joined_date = u.get("joined_at", "2024-01-01T")[:10]
-        if joined_date not in analytics:
-            analytics[joined_date] = 0
-        analytics[joined_date] += 1
-        
-    # Sort by date
-    sorted_analytics = dict(sorted(analytics.items(), key=lambda x: x[0], reverse=True))
-    return sorted_analytics
+# --- Analytics Operations ---
+# One daily_stats document per day ({"_id": "YYYY-MM-DD"}) with signups, orders_created,
+# orders_approved and expirations. Events bump it as they happen; rebuild_daily_stats
+# recomputes any range from the raw collections with aggregations.
+def bump_daily_stat(field, when, count=1, session=None):
+    bump_daily_stats({field: count}, when, session=session)
+
+def bump_daily_stats(counts, when, session=None):
+    """Several counters of one day in a single $inc."""
+    daily_stats_col.update_one({"_id": _day_key(when)}, {"$inc": counts}, upsert=True, session=session)
+
+def get_daily_analytics(start=None, end=None):
+    """Rollups between two YYYY-MM-DD dates (inclusive), newest first."""
+    query = {}
+    if start: query.setdefault("_id", {})["$gte"] = start
+    if end: query.setdefault("_id", {})["$lte"] = end
+    return list(daily_stats_col.find(query).sort("_id", -1))
+
+def _rollup(collection, match, date_field, fields):
+    collection.aggregate([
+        {"$match": match},
+        {"$group": {"_id": {"$dateToString": {"format": "%Y-%m-%d", "date": date_field}}, **fields}},
+        {"$merge": {"into": "daily_stats", "on": "_id", "whenMatched": "merge", "whenNotMatched": "insert"}}
+    ])
+
+def rebuild_daily_stats(start=None, end=None):
+    """Recomputes rollups for [start, end) (datetimes, default: everything) from raw data."""
+    def window(field, upper=None):
+        bounds = {"$type": "date"}
+        if start: bounds["$gte"] = start
+        if upper or end: bounds["$lt"] = min(d for d in (upper, end) if d)
+        return {field: bounds}
+
+    _rollup(users_col, window("joined_at"), "$joined_at", {"signups": {"$sum": 1}})
+    if not start:
+        # Users from the old JSON store have no joined_at; they were always reported as 2024-01-01
+        _rollup(users_col, {"joined_at": {"$exists": False}}, datetime(2024, 1, 1), {"signups": {"$sum": 1}})
+    _rollup(orders_col, window("created_at"), "$created_at", {"orders_created": {"$sum": 1}})
+    _rollup(orders_col, {"status": "SUCCESS", **window("created_at")}, {"$ifNull": ["$approved_at", "$created_at"]},
+            {"orders_approved": {"$sum": 1}})
+    _rollup(users_col, window("subscription_expiry", upper=datetime.now()), "$subscription_expiry", {"expirations": {"$sum": 1}})
+    waited_ms = {"$subtract": ["$approved_at", {"$ifNull": ["$started_at", "$created_at"]}]}
+    for via in ["admin", "gateway"]:
+        _rollup(orders_col, {"status": "SUCCESS", "approved_via": via, **window("approved_at")}, "$approved_at",
+                {f"approved_{via}": {"$sum": 1}, f"access_seconds_{via}": {"$sum": {"$divide": [waited_ms, 1000]}}})
+
+def backfill_daily_stats():
+    if daily_stats_col.estimated_document_count() == 0:
+        rebuild_daily_stats()
+        print("Daily analytics rebuilt from raw data.")
+
+# --- Broadcast Operations ---
+def create_broadcast(broadcast):
+    broadcast.update({
+        "status": "queued",
+        "cursor": None, # Highest user_id below which every recipient is done
+        "sent": 0,
+        "failed": 0,
+        "created_at": datetime.now()
+    })
+    broadcasts_col.insert_one(broadcast)
+    return broadcast
+
+def iter_broadcast_targets(target, after_user_id=None, batch_size=500):
+    """Cursor over {"user_id"} of a broadcast audience, in user_id order for resumable paging."""
+    now = datetime.now()
+    query = {}
+    if after_user_id is not None:
+        query["user_id"] = {"$gt": after_user_id}
+    # Audience is decided by the expiry date, not the (possibly stale) is_subscribed flag
+    if target == "active":
+        query["subscription_expiry"] = {"$gt": now}
+    elif target == "expired":
+        query["subscription_expiry"] = {"$not": {"$gt": now}}
+    return (users_col.find(query, {"user_id": 1, "_id": 0})
+            .sort("user_id", 1)
+            .hint([("user_id", 1), ("subscription_expiry", 1)])
+            .batch_size(batch_size))
+
+def get_broadcast(broadcast_id):
+    return broadcasts_col.find_one({"_id": broadcast_id})
+
+def claim_broadcast(broadcast_id, owner, stale_after):
+    """Marks a broadcast running for `owner`, atomically, so two workers (or a double-clicked
+    resume) never run it twice. A running broadcast whose heartbeat is older than stale_after
+    seconds is taken over, since its process is gone. Returns the claimed broadcast or None."""
+    now = datetime.now()
+    return broadcasts_col.find_one_and_update(
+        {"_id": broadcast_id, "$or": [
+            {"status": {"$in": ["queued", "interrupted"]}},
+            {"status": "running", "heartbeat_at": {"$lt": now - timedelta(seconds=stale_after)}}
+        ]},
+        {"$set": {"status": "running", "owner": owner, "started_at": now, "heartbeat_at": now}},
+        return_document=pymongo.ReturnDocument.AFTER
+    )
+
+def reserve_send_slot(name, interval):
+    """Global rate limiter shared by every process: hands out send times `interval` seconds
+    apart (epoch seconds). The caller sleeps until its slot."""
+    now = time.time()
+    doc = counters_col.find_one_and_update(
+        {"_id": name},
+        [{"$set": {"next_slot": {"$add": [{"$max": [now, {"$ifNull": ["$next_slot", 0]}]}, interval]}}}],
+        upsert=True,
+        return_document=pymongo.ReturnDocument.AFTER
+    )
+    return doc["next_slot"] - interval
+
+def delay_send_slots(name, until):
+    # After a 429 nobody sends before retry_after is over, in any process
+    counters_col.update_one({"_id": name}, {"$max": {"next_slot": until}}, upsert=True)
+
+def update_broadcast(broadcast_id, fields):
+    broadcasts_col.update_one({"_id": broadcast_id}, {"$set": fields})
+
+# --- Ledger Operations ---
+# Running totals ({"_id": "totals"}) and per-day buckets ({"_id": "YYYY-MM-DD"}), bumped by
+# approve_order / add_payout, so the dashboard reads earnings without touching orders.
+# Like the old report, an order counts towards the day it was created on.
+def _day_key(value):
+    if isinstance(value, datetime):
+        return value.date().isoformat()
+    if isinstance(value, str) and len(value) >= 10:
+        return value[:10]
+    return datetime.now().date().isoformat()
+
+def _to_amount(value):
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return 0.0
+
+def record_earning(amount, created_at, session=None):
+    inc = {"$inc": {"earnings": _to_amount(amount), "orders": 1}}
+    ledger_col.bulk_write([
+        pymongo.UpdateOne({"_id": "totals"}, inc, upsert=True),
+        pymongo.UpdateOne({"_id": _day_key(created_at)}, inc, upsert=True)
+    ], session=session)
+
+def backfill_ledger():
+    """Builds the ledger from existing orders and payouts. Only runs while it doesn't exist yet."""
+    if not ledger_col.find_one({"_id": "totals"}):
+        rebuild_ledger()
+
+def rebuild_ledger():
+    """Recomputes the ledger totals and day buckets from orders and payouts."""
+    amount = {"$convert": {"input": "$amount", "to": "double", "onError": 0, "onNull": 0}}
+    day = {"$cond": [
+        {"$eq": [{"$type": "$created_at"}, "date"]},
+        {"$dateToString": {"format": "%Y-%m-%d", "date": "$created_at"}},
+        {"$substrCP": [{"$ifNull": ["$created_at", ""]}, 0, 10]}
+    ]}
+    days = list(orders_col.aggregate([
+        {"$match": {"status": "SUCCESS"}},
+        {"$group": {"_id": day, "earnings": {"$sum": amount}, "orders": {"$sum": 1}}}
+    ]))
+    paid = list(payouts_col.aggregate([{"$group": {"_id": None, "paid": {"$sum": amount}}}]))
+
+    updates = [pymongo.ReplaceOne({"_id": d["_id"]}, d, upsert=True) for d in days if d["_id"]]
+    updates.append(pymongo.ReplaceOne({"_id": "totals"}, {
+        "earnings": sum(d["earnings"] for d in days),
+        "orders": sum(d["orders"] for d in days),
+        "paid": paid[0]["paid"] if paid else 0
+    }, upsert=True))
+    ledger_col.bulk_write(updates, ordered=False)
+    print(f"Ledger backfilled from {len(days)} days of orders.")
 
 # --- Payout Operations ---
 def add_payout(amount, note=""):
     payout = {
-        "id": str(payouts_col.count_documents({}) + 1),
+        "id": str(next_sequence("payouts")),
         "amount": float(amount),
         "date": datetime.now().isoformat(),
         "note": note
     }
-    payouts_col.insert_one(payout)
+
+    def record(session):
+        # The id is taken outside: a retried transaction just leaves a gap in the sequence
+        payouts_col.insert_one(dict(payout), session=session)
+        ledger_col.update_one({"_id": "totals"}, {"$inc": {"paid": payout["amount"]}}, upsert=True, session=session)
+
+    run_in_transaction(record)
     return payout
 
 def get_payouts():
     return list(payouts_col.find())
 
 def get_total_paid():
-    total = 0
-    for p in payouts_col.find():
-        try:
-            total += float(p["amount"])
-        except:
-            pass
-    return total
+    totals = ledger_col.find_one({"_id": "totals"})
+    return totals.get("paid", 0) if totals else 0
@@ -1,43 +1,143 @@
+import argparse
 import json
-import pymongo
-import config
 import os
+import time
+from datetime import datetime
+import ijson
+import pymongo
+from pymongo.errors import BulkWriteError
+import database
+import migrations
+
+# Streams an export (db.json / db_migrated.json) into Mongo without loading it into memory.
+# Rows are upserted by their natural id with $setOnInsert, so re-running is harmless and
+# never overwrites newer data already in the database; a checkpoint file lets an
+# interrupted run skip what it already wrote.
+
+# section -> (collection, how the section is laid out, natural key)
+SECTIONS = {
+    "users": (database.users_col, "dict", "user_id"),
+    "videos": (database.videos_col, "list", "message_id"),
+    "orders": (database.orders_col, "dict", "order_id"),
+    "payouts": (database.payouts_col, "list", "id"),
+}
+DATE_FIELDS = ["subscription_expiry", "joined_at", "created_at", "approved_at"]
+
+def iter_rows(path, section, layout):
+    with open(path, "rb") as f:
+        if layout == "dict":
+            for _, row in ijson.kvitems(f, section, use_float=True):
+                yield row
+        else:
+            yield from ijson.items(f, f"{section}.item", use_float=True)
+
+def normalize(row):
+    # Same shape the migrations produce, so imported rows need no migration pass afterwards
+    if isinstance(row.get("user_id"), str) and row["user_id"].isdigit():
+        row["user_id"] = int(row["user_id"])
+    for field in DATE_FIELDS:
+        if isinstance(row.get(field), str):
+            try:
+                row[field] = datetime.fromisoformat(row[field])
+            except ValueError:
+                row[field] = None
+    return row
+
+def row_filter(row, key):
+    if key == "message_id" and row.get("message_id") is None:
+        # Videos saved before the channel index have no message id
+        return {"sequence_id": row.get("sequence_id")}
+    return {key: row.get(key)}
+
+def load_checkpoint(path):
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {}
+
+def save_checkpoint(path, checkpoint):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp, path)
+
+def import_section(path, section, checkpoint, args):
+    collection, layout, key = SECTIONS[section]
+    done = checkpoint.get(section, 0)
+    batch, seen, inserted, skipped, failed = [], 0, 0, 0, 0
+    started = time.time()
+
+    def flush():
+        nonlocal inserted
+        nonlocal failed
+        if batch and not args.dry_run:
+            try:
+                inserted += collection.bulk_write(batch, ordered=False).upserted_count
+            except BulkWriteError as e:
+                # Unordered: everything but the failing rows was written
+                inserted += e.details["nUpserted"]
+                failed += len(e.details["writeErrors"])
+                for error in e.details["writeErrors"][:3]:
+                    print(f"  {section}: {error['errmsg']}")
+        batch.clear()
+        checkpoint[section] = seen
+        if not args.dry_run:
+            save_checkpoint(args.checkpoint, checkpoint)
+        rate = (seen - done) / max(time.time() - started, 1e-6)
+        print(f"  {section}: {seen} rows read, {inserted} new ({rate:.0f} rows/s)")
+
+    for row in iter_rows(path, section, layout):
+        seen += 1
+        if seen <= done:
+            continue
+        row = normalize(row)
+        natural_key = row_filter(row, key)
+        if None in natural_key.values():
+            skipped += 1
+            continue
+        batch.append(pymongo.UpdateOne(natural_key, {"$setOnInsert": row}, upsert=True))
+        if len(batch) >= args.batch_size:
+            flush()
+    flush()
+    if skipped:
+        print(f"  {section}: skipped {skipped} rows without {key}")
+    if failed:
+        print(f"  {section}: {failed} rows failed to write")
+    return seen - done, inserted
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Stream a JSON export into MongoDB")
+    parser.add_argument("path", nargs="?", default="db_migrated.json")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--resume", action="store_true", help="skip rows a previous run already wrote")
+    parser.add_argument("--dry-run", action="store_true", help="parse and count only, write nothing")
+    parser.add_argument("--checkpoint", help="defaults to <path>.checkpoint")
+    args = parser.parse_args()
+    args.checkpoint = args.checkpoint or f"{args.path}.checkpoint"
+
+    checkpoint = load_checkpoint(args.checkpoint) if args.resume else {}
+    if not args.dry_run:
+        # Indexes first: every upsert looks its natural key up. Not migrations.run(): on a fresh
+        # database its first step would load db.json whole, which is what this script avoids
+        migrations.ensure_indexes()
+
+    started = time.time()
+    total_rows = total_new = 0
+    for section in SECTIONS:
+        print(f"Importing {section}...")
+        rows, new = import_section(args.path, section, checkpoint, args)
+        total_rows += rows
+        total_new += new
+    elapsed = time.time() - started
+
+    if not args.dry_run:
+        # Imported videos/payouts carry ids the counters must not hand out again, and
+        # imported orders change earnings and analytics
+        migrations.migrate_sequence_counters()
+        database.rebuild_ledger()
+        database.rebuild_daily_stats()
+        if os.path.exists(args.checkpoint):
+            os.remove(args.checkpoint)
 
-print("Connecting to MongoDB...")
-client = pymongo.MongoClient(config.MONGO_URI)
-db = client[config.DB_NAME]
-
-print("Loading data from db_migrated.json...")
-with open('db_migrated.json', 'r') as f:
-    data = json.load(f)
-
-print("Dropping existing collections...")
-db.users.drop()
-db.videos.drop()
-db.orders.drop()
-db.payouts.drop()
-
-print("Inserting data...")
-if "users" in data:
-    users_list = list(data["users"].values())
-    if users_list: 
-        db.users.insert_many(users_list)
-        print(f"Inserted {len(users_list)} users.")
-        
-if "videos" in data:
-    if data["videos"]: 
-        db.videos.insert_many(data["videos"])
-        print(f"Inserted {len(data['videos'])} videos.")
-        
-if "orders" in data:
-    orders_list = list(data["orders"].values())
-    if orders_list: 
-        db.orders.insert_many(orders_list)
-        print(f"Inserted {len(orders_list)} orders.")
-        
-if "payouts" in data:
-    if data["payouts"]: 
-        db.payouts.insert_many(data["payouts"])
-        print(f"Inserted {len(data['payouts'])} payouts.")
-
-print("Successfully imported db_migrated.json to MongoDB!")
+    mode = " (dry run)" if args.dry_run else ""
+    print(f"Processed {total_rows} rows in {elapsed:.1f}s ({total_rows / max(elapsed, 1e-6):.0f} rows/s), {total_new} new{mode}.")
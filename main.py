@@ -1,12 +1,20 @@
 import os
 import time
+import asyncio
 import random
 import logging
 import uuid
+from datetime import datetime
 import config
 import database as db
+import async_database as adb
+import media_utils
+import migrations
+import paytm_utils
+import screenshot_store
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaVideo
-from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, CallbackQueryHandler, MessageHandler, filters
+from telegram.error import BadRequest, NetworkError, RetryAfter
+from telegram.ext import ApplicationBuilder, BaseUpdateProcessor, ContextTypes, CommandHandler, CallbackQueryHandler, MessageHandler, filters
 from telegram.request import HTTPXRequest
 
 # Logging setup
@@ -23,16 +31,13 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
     print(f"⚠️ Error handled: {context.error}")
 
 
-# State for manual payments: {user_id: {"plan_name": str, "price": int}}
-PENDING_PAYMENTS = {}
-
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     print(f"Received /start from {update.effective_user.id}") # DEBUG
     user_id = update.effective_user.id
     
     # Ensure user exists in DB
     try:
-        user = db.get_user(user_id)
+        user = await adb.get_user(user_id, fresh=True)
         print(f"User fetched: {user}") # DEBUG
     except Exception as e:
         print(f"DB Error: {e}")
@@ -44,11 +49,26 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await show_subscription_plans(update, context)
 
-async def show_subscription_plans(update: Update, context: ContextTypes.DEFAULT_TYPE, message_text=None):
-    user_id = update.effective_user.id
-    user = db.get_user(user_id)
-    
-    plans = db.get_pricing_plans()
+async def send_cached_photo(bot, chat_id, photo_path, **kwargs):
+    """send_photo that uploads a file only once and reuses Telegram's file_id afterwards."""
+    file_id = await asyncio.to_thread(media_utils.get_file_id, photo_path)
+    if file_id:
+        try:
+            return await bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+        except BadRequest as e:
+            # e.g. "Wrong file identifier/http url specified". Anything else (caption markup,
+            # chat not found) is not the file_id's fault, and the registry is shared by every process
+            if "file" not in e.message.lower():
+                raise
+            print(f"Cached file_id rejected for {photo_path}, re-uploading: {e}")
+            await asyncio.to_thread(media_utils.forget, photo_path)
+
+    with open(photo_path, 'rb') as photo:
+        msg = await bot.send_photo(chat_id=chat_id, photo=photo, **kwargs)
+    await asyncio.to_thread(media_utils.remember_file_id, photo_path, msg.photo[-1].file_id)
+    return msg
+
+def build_plans_keyboard(plans, user):
     keyboard = []
     for plan_name, details in plans.items():
         # Check if it's a URL-based plan (Demo)
@@ -62,7 +82,13 @@ async def show_subscription_plans(update: Update, context: ContextTypes.DEFAULT_
             
         keyboard.append([InlineKeyboardButton(f"{plan_name} - ₹{details['price']}", callback_data=f"plan_{plan_name}")])
     
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    return InlineKeyboardMarkup(keyboard)
+
+async def show_subscription_plans(update: Update, context: ContextTypes.DEFAULT_TYPE, message_text=None):
+    user_id = update.effective_user.id
+    user = await adb.get_user(user_id)
+    
+    reply_markup = build_plans_keyboard(db.get_pricing_plans(), user)
     
     if message_text:
         text = message_text
@@ -103,8 +129,7 @@ async def show_subscription_plans(update: Update, context: ContextTypes.DEFAULT_
 
         if photo_path:
             try:
-                with open(photo_path, 'rb') as photo:
-                    await context.bot.send_photo(chat_id=update.effective_user.id, photo=photo, caption=text, reply_markup=reply_markup)
+                await send_cached_photo(context.bot, update.effective_user.id, photo_path, caption=text, reply_markup=reply_markup)
             except Exception as e:
                 print(f"Error sending photo: {e}")
                 await context.bot.send_message(chat_id=update.effective_user.id, text=text, reply_markup=reply_markup)
@@ -113,19 +138,27 @@ async def show_subscription_plans(update: Update, context: ContextTypes.DEFAULT_
     else:
         if photo_path:
             try:
-                with open(photo_path, 'rb') as photo:
-                    await update.message.reply_photo(photo=photo, caption=text, reply_markup=reply_markup)
+                await send_cached_photo(context.bot, update.effective_chat.id, photo_path, caption=text, reply_markup=reply_markup)
             except Exception as e:
                 print(f"Error sending photo: {e}")
                 await update.message.reply_text(text, reply_markup=reply_markup)
         else:
             await update.message.reply_text(text, reply_markup=reply_markup)
 
-async def show_video_interface(update: Update, context: ContextTypes.DEFAULT_TYPE, retry_count=0, is_looping=False):
+def is_missing_post(error):
+    """True only when Telegram says the channel post itself is gone or can't be copied. Timeouts,
+    flood control or a user who blocked the bot say nothing about the post."""
+    if not isinstance(error, BadRequest):
+        return False
+    # Only the post-level errors: "Chat not found" means the bot lost the channel, not the post
+    text = error.message.lower()
+    return "message to copy not found" in text or "message can't be copied" in text
+
+async def show_video_interface(update: Update, context: ContextTypes.DEFAULT_TYPE, msg_id=None, retry_count=0, is_looping=False):
     user_id = update.effective_user.id
     
     # Check validity
-    user = db.get_user(user_id)
+    user = await adb.get_user(user_id)
     if not user.get("is_subscribed"):
         # User is not subscribed (or expired just now)
         msg = "⚠️ **Your plan has EXPIRED!** ⚠️\n\nPlease renew your subscription to continue watching."
@@ -141,13 +174,21 @@ async def show_video_interface(update: Update, context: ContextTypes.DEFAULT_TYP
 
     # --- DIRECT CHANNEL MODE (ALWAYS ACTIVE) ---
     # Treat 'current_video_index' as the actual Message ID in the channel
-    # Default to config.CHANNEL_START_ID
-    current_msg_id = user.get("current_video_index", config.CHANNEL_START_ID)
+    # Default to config.CHANNEL_START_ID. Navigation passes the target id in, and it is
+    # only persisted (together with the sent message id) once a copy succeeds.
+    current_msg_id = msg_id if msg_id is not None else user.get("current_video_index", config.CHANNEL_START_ID)
     
     # Validation: Ensure we don't go below start ID
     if current_msg_id < config.CHANNEL_START_ID:
         current_msg_id = config.CHANNEL_START_ID
-        db.update_video_index(user_id, current_msg_id)
+
+    # Jump straight to the next indexed post (None = index empty, fall back to probing ids)
+    indexed_id = db.resolve_video_id(current_msg_id)
+    if indexed_id is not None:
+        if indexed_id < current_msg_id and update.callback_query:
+            try: await update.callback_query.answer("↺ Playlist ended. Restarting...")
+            except: pass
+        current_msg_id = indexed_id
 
     # 2. FETCH & SEND (New Strategy: Copy New -> Delete Old)
     # This avoids "Temp Copy" weirdness and ensures robust handling of all media types.
@@ -185,29 +226,39 @@ async def show_video_interface(update: Update, context: ContextTypes.DEFAULT_TYP
             except:
                 pass
         
-        # C. Update State
-        db.update_last_message_id(user_id, new_msg.message_id)
+        # C. Update State (single write)
+        await adb.update_view_state(user_id, current_msg_id, new_msg.message_id)
 
     except Exception as e:
         print(f"Fetch Error (ID {current_msg_id}): {e}")
+        if not is_missing_post(e):
+            # The post is fine; don't touch the index or skip ahead, just let the user tap again
+            if isinstance(e, RetryAfter) and update.callback_query:
+                try: await update.callback_query.answer(f"⏳ Too many requests, try again in {int(e.retry_after)}s.")
+                except: pass
+            return
+
+        # Indexed post is gone from the channel: drop it and move to its neighbour
+        if indexed_id is not None and retry_count < 10:
+            await asyncio.to_thread(db.remove_video, current_msg_id)
+            await show_video_interface(update, context, msg_id=current_msg_id + 1, retry_count=retry_count+1, is_looping=True)
+            return
         
         # AUTO-SKIP LOGIC / RECURSION
-        if retry_count < 10: # Limit retries
+        if indexed_id is None and retry_count < 10: # Limit retries
             next_id = current_msg_id + 1
             print(f"⚠️ Skipping ID {current_msg_id} -> Trying {next_id} (Retry {retry_count+1}/10)")
-            db.update_video_index(user_id, next_id)
-            await show_video_interface(update, context, retry_count=retry_count+1, is_looping=is_looping)
+            await show_video_interface(update, context, msg_id=next_id, retry_count=retry_count+1, is_looping=is_looping)
             return
 
         # If we ran out of retries, maybe we reached the END of the channel?
         # Try LOOPING back to start?
         if not is_looping:
             print(f"⚠️ End of channel reached (or large gap). Looping to start.")
-            db.update_video_index(user_id, config.CHANNEL_START_ID)
             if update.callback_query:
                 try: await update.callback_query.answer("↺ Playlist ended. Restarting...")
                 except: pass
-            await show_video_interface(update, context, retry_count=0, is_looping=True)
+            await show_video_interface(update, context, msg_id=config.CHANNEL_START_ID, retry_count=0, is_looping=True)
             return
 
         # Fallback if too many retries AND we already looped (Infinite loop prevention)
@@ -240,161 +291,387 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Helper: Bypass for Demo
         if plan["price"] == 0:
             # Check if already used
-            user = db.get_user(user_id)
+            user = await adb.get_user(user_id)
             if user.get("demo_used"):
                 await query.answer("⚠️ You have already used the Free Demo!", show_alert=True)
                 return
 
-            db.update_user_subscription(user_id, days=plan.get("days", 0), minutes=plan.get("minutes", 0))
-            db.mark_demo_used(user_id) # Mark as used
+            await adb.update_user_subscription(user_id, days=plan.get("days", 0), minutes=plan.get("minutes", 0))
+            await adb.mark_demo_used(user_id) # Mark as used
             
             await query.message.delete()
             await context.bot.send_message(chat_id=user_id, text="✅ Demo Activated! You have access for 1 minute.")
             await show_video_interface(update, context)
             return
 
+        # AUTOMATED PAYMENT FLOW (falls through to the QR flow if the gateway is unavailable)
+        if config.PAYMENT_MODE == "auto" and paytm_utils.is_configured():
+            if await start_gateway_payment(query, context, user_id, plan_name, plan):
+                return
+
         # MANUAL PAYMENT FLOW
         # 1. Send QR Code
         try:
-            with open(config.QR_CODE_PATH, 'rb') as photo:
-                caption = (
-                    f"📦 **Plan:** {plan_name}\n"
-                    f"💰 **Amount:** ₹{plan['price']}\n\n"
-                    "📷 **Scan the QR Code to Pay.**\n"
-                    "📤 **After paying, send the successful payment SCREENSHOT here.**"
-                )
-                await query.message.delete()
-                await context.bot.send_photo(chat_id=user_id, photo=photo, caption=caption, parse_mode="Markdown")
-                
-                # Set State
-                PENDING_PAYMENTS[user_id] = plan
+            caption = (
+                f"📦 **Plan:** {plan_name}\n"
+                f"💰 **Amount:** ₹{plan['price']}\n\n"
+                "📷 **Scan the QR Code to Pay.**\n"
+                "📤 **After paying, send the successful payment SCREENSHOT here.**"
+            )
+            if not os.path.exists(config.QR_CODE_PATH):
+                raise FileNotFoundError(config.QR_CODE_PATH)
+            await query.message.delete()
+            await send_cached_photo(context.bot, user_id, config.QR_CODE_PATH, caption=caption, parse_mode="Markdown")
+            
+            # Set State
+            await adb.set_pending_payment(user_id, plan_name, plan)
                 
         except FileNotFoundError:
              await context.bot.send_message(chat_id=user_id, text="❌ Error: QR Code not found. Contact Admin.")
 
     elif data.startswith("check_"):
-        # Deprecated logic, but keeping handler to avoid crashes if old buttons exist
-        await query.answer("Please send screenshot instead.")
+        await check_gateway_payment(update, context, data[len("check_"):])
              
     # --- Direct Mode Handlers (ONLY) ---
     elif data == "vid_next_direct":
-        user = db.get_user(user_id)
+        user = await adb.get_user(user_id)
         # Increment Message ID
         current = user.get("current_video_index", config.CHANNEL_START_ID)
-        db.update_video_index(user_id, current + 1)
-        await show_video_interface(update, context)
+        await show_video_interface(update, context, msg_id=current + 1)
         
     elif data == "vid_prev_direct":
-        user = db.get_user(user_id)
+        user = await adb.get_user(user_id)
         current = user.get("current_video_index", config.CHANNEL_START_ID)
-        if current > config.CHANNEL_START_ID:
-            db.update_video_index(user_id, current - 1)
-        await show_video_interface(update, context)
+        prev_id = db.get_prev_video_id(current)
+        if prev_id is None:
+            prev_id = max(current - 1, config.CHANNEL_START_ID)
+        await show_video_interface(update, context, msg_id=prev_id)
+
+async def start_gateway_payment(query, context, user_id, plan_name, plan):
+    """Creates the order upfront and sends a Paytm checkout link. False if the gateway didn't give a token."""
+    order_id = str(uuid.uuid4()).replace("-", "")[:10]
+    try:
+        txn_token = await paytm_utils.get_async_client().initiate_transaction(order_id, plan["price"], user_id)
+    except Exception as e:
+        print(f"⚠️ Paytm initiate failed for {user_id}: {e}")
+        txn_token = None
+    if not txn_token:
+        return False
+
+    await adb.create_order(order_id, user_id, plan["price"], days=plan["days"],
+                           status="AWAITING_PAYMENT", started_at=datetime.now(), txn_token=txn_token)
+    # The screenshot fallback attaches to this same order
+    await adb.set_pending_payment(user_id, plan_name, plan, order_id=order_id)
+
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton(f"💳 Pay ₹{plan['price']}", url=paytm_utils.payment_page_url(order_id))],
+        [InlineKeyboardButton("✅ I've Paid", callback_data=f"check_{order_id}")]
+    ])
+    await query.message.delete()
+    await context.bot.send_message(
+        chat_id=user_id,
+        text=(
+            f"📦 **Plan:** {plan_name}\n"
+            f"💰 **Amount:** ₹{plan['price']}\n\n"
+            "💳 **Tap Pay to complete the payment.** Access is activated automatically.\n"
+            "📤 Problems? Send the payment SCREENSHOT here instead."
+        ),
+        reply_markup=keyboard,
+        parse_mode="Markdown"
+    )
+    return True
+
+async def check_gateway_payment(update: Update, context: ContextTypes.DEFAULT_TYPE, order_id):
+    """The "I've Paid" button: asks Paytm right away instead of waiting for the reconcile job."""
+    user_id = update.effective_user.id
+    order = await asyncio.to_thread(db.get_order, order_id)
+    if not order or int(order["user_id"]) != user_id:
+        return
+    if order["status"] == "SUCCESS":
+        await context.bot.send_message(chat_id=user_id, text="✅ This payment is already confirmed. Use /start.")
+        return
+
+    try:
+        response = await paytm_utils.get_async_client().transaction_status(order_id)
+        approved = await asyncio.to_thread(paytm_utils.settle, order, response)
+    except Exception as e:
+        print(f"⚠️ Paytm status check failed for {order_id}: {e}")
+        approved = None
+    if not approved:
+        await context.bot.send_message(
+            chat_id=user_id,
+            text="⏳ Payment not confirmed yet. It is checked automatically; if you already paid, you can also send the SCREENSHOT here."
+        )
+        return
+
+    await adb.clear_pending_payment(user_id)
+    await context.bot.send_message(chat_id=user_id, text="✅ **Payment confirmed!** Your subscription is active.", parse_mode="Markdown")
+    await show_video_interface(update, context)
 
 async def handle_screenshot(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
     # Check if user has a pending payment
-    plan = PENDING_PAYMENTS.get(user_id)
-    if not plan:
+    intent = await adb.get_pending_payment(user_id)
+    if not intent:
         await update.message.reply_text("❓ You haven't selected a plan. Please use /start to select a plan first.")
         return
+    plan = intent["plan"]
 
     # Process Screenshot
     photo = update.message.photo[-1] # Largest size
     file = await context.bot.get_file(photo.file_id)
     
-    # Create Order ID
-    order_id = str(uuid.uuid4()).replace("-", "")[:10]
+    # Stored by content hash; the same image sent before is flagged for the admin
+    screenshot = await screenshot_store.save_from_telegram(file)
+    previous = await asyncio.to_thread(db.find_order_by_screenshot, screenshot["screenshot_sha256"])
+    screenshot["screenshot_reused"] = previous is not None
+    if previous:
+        screenshot["reused_from"] = previous["order_id"]
+    if screenshot["screenshot_phash"]:
+        # Near-duplicates too: re-saved, cropped or recompressed copies of earlier screenshots
+        screenshot["screenshot_matches"] = await asyncio.to_thread(screenshot_store.find_similar, screenshot["screenshot_phash"])
     
-    # Save Path
-    filename = f"{order_id}.jpg"
-    file_path = os.path.join(config.UPLOAD_FOLDER, filename)
-    await file.download_to_drive(file_path)
+    # Reuse the gateway order started for this plan if it is still unpaid, else create an order
+    order_id = intent.get("order_id")
+    attached = bool(order_id) and await adb.attach_screenshot(order_id, screenshot)
     
     # Create Database Entry
-    db.create_order(order_id, user_id, plan["price"], screenshot_path=f"screenshots/{filename}", days=plan["days"])
+    if not attached:
+        order_id = str(uuid.uuid4()).replace("-", "")[:10]
+        await adb.create_order(order_id, user_id, plan["price"], days=plan["days"],
+                               started_at=intent.get("selected_at"), **screenshot)
+    if screenshot["screenshot_phash"]:
+        await asyncio.to_thread(screenshot_store.index_screenshot, order_id, user_id, screenshot["screenshot_phash"])
     
     # Clear State
-    del PENDING_PAYMENTS[user_id]
+    await adb.clear_pending_payment(user_id)
     
     await update.message.reply_text("✅ **Screenshot Received!**\n\nWaiting for admin approval, just 2min wait...", parse_mode="Markdown")
 
+async def index_channel_post(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Adds every new post of the private channel to the video index."""
+    post = update.channel_post
+    attachment = post.effective_attachment
+    if isinstance(attachment, tuple): # Photos come as a tuple of sizes
+        attachment = attachment[-1] if attachment else None
+    file_id = getattr(attachment, "file_id", None)
+    await asyncio.to_thread(db.add_video, file_id, post.caption or post.text or "", message_id=post.message_id)
+
+async def backfill(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin: /backfill <from_id> <to_id> probes existing channel posts into the video index."""
+    if update.effective_user.id != config.ADMIN_ID:
+        return
+    try:
+        start_id, end_id = int(context.args[0]), int(context.args[1])
+    except (IndexError, ValueError):
+        await update.message.reply_text("Usage: /backfill <from_id> <to_id>")
+        return
+
+    await update.message.reply_text(f"🔎 Indexing channel posts {start_id}..{end_id}...")
+    # Runs in the background so other updates keep flowing while we probe
+    context.application.create_task(backfill_video_index(context.bot, start_id, end_id))
+
+async def backfill_video_index(bot, start_id, end_id):
+    known = set(db.get_video_ids())
+    found = 0
+    for message_id in range(start_id, end_id + 1):
+        if message_id in known:
+            found += 1
+            continue
+        # The Bot API can't list channel history, so copy each id to the admin and delete it again.
+        # Paced, since a large range would otherwise run straight into flood control.
+        await asyncio.sleep(config.BACKFILL_PROBE_INTERVAL)
+        probe, attempts = None, 0
+        while True:
+            try:
+                probe = await bot.copy_message(
+                    chat_id=config.ADMIN_ID,
+                    from_chat_id=config.PRIVATE_CHANNEL_ID,
+                    message_id=message_id,
+                    disable_notification=True
+                )
+                break
+            except RetryAfter as e:
+                await asyncio.sleep(float(e.retry_after) + 1)
+            except BadRequest as e:
+                if is_missing_post(e):
+                    break
+                await bot.send_message(chat_id=config.ADMIN_ID, text=f"⚠️ Backfill stopped at {message_id}: {e.message}")
+                return
+            except NetworkError:
+                # Timeouts included; after a few tries the range isn't trustworthy any more
+                attempts += 1
+                if attempts >= 3:
+                    await bot.send_message(chat_id=config.ADMIN_ID, text=f"⚠️ Backfill stopped at {message_id}: network errors. Run it again from there.")
+                    return
+                await asyncio.sleep(5)
+        if probe is None:
+            continue
+        try:
+            await bot.delete_message(chat_id=config.ADMIN_ID, message_id=probe.message_id)
+        except Exception:
+            pass
+        await asyncio.to_thread(db.add_video, None, "", message_id=message_id)
+        found += 1
+    await bot.send_message(chat_id=config.ADMIN_ID, text=f"✅ Backfill done. {found} posts in range, {len(db.get_video_ids())} indexed in total.")
+
 async def check_expiry_job(context: ContextTypes.DEFAULT_TYPE):
     """Background job to check for expired users and vanish their content."""
-    users = db.get_all_users()
+    # Only users whose expiry passed since the last tick come back (indexed range query),
+    # and they are already flipped to unsubscribed with last_message_id cleared.
+    users = await adb.expire_due_users()
+    if not users:
+        return
+
+    plans = db.get_pricing_plans()
+    msg = "⚠️ **Your plan has EXPIRED!** ⚠️\n\nThe video has been removed. Please renew to continue."
     for user in users:
         user_id = user['user_id']
-        
-        # Check if expired
-        is_expired = False
-        if not user.get("is_subscribed"):
-            is_expired = True
-            
-        # Check date (double check, as db.get_all_users doesn't auto-expire without get_user call)
-        # We should probably run db.get_user(user_id) to trigger the expiry logic inside it,
-        # OR just duplicate the logic here for efficiency.
-        # Let's rely on db.get_user to update state if needed.
-        user = db.get_user(user_id) # This updates 'is_subscribed' if time passed
-        
-        if not user.get("is_subscribed") and user.get("last_message_id"):
-            # Vanish!
-            try:
-                await context.bot.delete_message(chat_id=user_id, message_id=user["last_message_id"])
-            except Exception as e:
-                print(f"Failed to vanish message for {user_id}: {e}")
-            
-            # Send Expired Message
-            try:
-                msg = "⚠️ **Your plan has EXPIRED!** ⚠️\n\nThe video has been removed. Please renew to continue."
-                
-                # We need to send plans. We can't reuse show_subscription_plans easily without 'update' object.
-                # So we reproduce a simple version or refactor.
-                # Refactoring 'show_subscription_plans' to check for update is best.
-                # For now, let's just send text + inline keyboard manually.
-                
-                plans = db.get_pricing_plans()
-                keyboard = []
-                for plan_name, details in plans.items():
-                    if details.get('url'):
-                        keyboard.append([InlineKeyboardButton(plan_name, url=details['url'])])
-                        continue
-                    if details['price'] == 0 and user.get("demo_used"):
-                        continue
-                    keyboard.append([InlineKeyboardButton(f"{plan_name} - ₹{details['price']}", callback_data=f"plan_{plan_name}")])
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                await context.bot.send_message(chat_id=user_id, text=msg, reply_markup=reply_markup, parse_mode="Markdown")
-                
-            except Exception as e:
-                print(f"Failed to send expiry msg to {user_id}: {e}")
-                
-            # Clear last_message_id so we don't loop
-            db.update_last_message_id(user_id, None)
+
+        # Vanish!
+        try:
+            await context.bot.delete_message(chat_id=user_id, message_id=user["last_message_id"])
+        except Exception as e:
+            print(f"Failed to vanish message for {user_id}: {e}")
+
+        # Send Expired Message
+        try:
+            reply_markup = build_plans_keyboard(plans, user)
+            await context.bot.send_message(chat_id=user_id, text=msg, reply_markup=reply_markup, parse_mode="Markdown")
+        except Exception as e:
+            print(f"Failed to send expiry msg to {user_id}: {e}")
+
+async def refresh_settings_job(context: ContextTypes.DEFAULT_TYPE):
+    """Picks up pricing / menu text edits made from the dashboard."""
+    if await asyncio.to_thread(db.refresh_settings):
+        print("🔄 Settings reloaded.")
+
+async def reconcile_payments_job(context: ContextTypes.DEFAULT_TYPE):
+    """Approves pending orders that Paytm reports as paid, without waiting for the admin."""
+    approved = await paytm_utils.reconcile_pending_orders(paytm_utils.get_async_client())
+    for order in approved:
+        print(f"✅ Order {order['order_id']} approved from Paytm status.")
+        await adb.clear_pending_payment(order["user_id"])
+        try:
+            await context.bot.send_message(
+                chat_id=order["user_id"],
+                text="✅ **Your subscription has been APPROVED!**\n\nYou can now access the premium content. Use /start if needed.",
+                parse_mode="Markdown"
+            )
+        except Exception as e:
+            print(f"Failed to notify {order['user_id']}: {e}")
+
+async def purge_screenshots_job(context: ContextTypes.DEFAULT_TYPE):
+    """Deletes screenshot files of settled orders past the retention window."""
+    purged = await asyncio.to_thread(screenshot_store.purge_expired)
+    if purged:
+        print(f"🧹 Purged screenshots of {purged} old orders.")
+
+async def log_pool_stats_job(context: ContextTypes.DEFAULT_TYPE):
+    """Logs Mongo pool usage so MONGO_MAX_POOL_SIZE can be sized for the bot process."""
+    logging.info("Mongo pool stats: sync=%s async=%s", db.pool_stats(), adb.pool_stats())
+
+async def post_shutdown(application):
+    await adb.close()
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Handles updates concurrently, but one at a time per user so each user's taps stay in order."""
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._locks = {} # user/chat id -> [lock, waiting updates]
+
+    async def process_update(self, update, coroutine):
+        # The user's lock is taken before the base class takes a slot of the global semaphore,
+        # so one user's queued updates wait here instead of holding every slot
+        key = None
+        if isinstance(update, Update):
+            key = update.effective_user.id if update.effective_user else getattr(update.effective_chat, "id", None)
+        if key is None:
+            await super().process_update(update, coroutine)
+            return
+
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]: # asyncio.Lock is FIFO, so arrival order is kept
+                await super().process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
 
 if __name__ == '__main__':
+    if config.BOT_MODE == "webhook" and not (config.WEBHOOK_SECRET and config.WEBHOOK_URL):
+        # Without the secret anyone could post forged updates; without the URL Telegram is never told where to send them
+        raise SystemExit("Webhook mode needs both WEBHOOK_SECRET and WEBHOOK_URL")
+
     # usage of custom request to handle network flakiness
     request = HTTPXRequest(
+        connection_pool_size=config.MAX_CONCURRENT_UPDATES,
         connect_timeout=60.0,
         read_timeout=60.0,
         pool_timeout=60.0
     )
-    application = ApplicationBuilder().token(config.BOT_TOKEN).request(request).build()
+    application = (
+        ApplicationBuilder()
+        .token(config.BOT_TOKEN)
+        .request(request)
+        .concurrent_updates(PerUserUpdateProcessor(config.MAX_CONCURRENT_UPDATES))
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+
+    migrations.run()
+    # Warm the in-memory settings and video index so handlers never load them on the event loop
+    db.refresh_settings()
+    db.get_video_ids()
     
     application.add_handler(CommandHandler('start', start))
+    application.add_handler(CommandHandler('backfill', backfill))
     application.add_handler(CallbackQueryHandler(button_callback))
+    if config.PRIVATE_CHANNEL_ID:
+        # Must come before the PHOTO handler, which would otherwise swallow channel photo posts
+        application.add_handler(MessageHandler(filters.UpdateType.CHANNEL_POST & filters.Chat(chat_id=int(config.PRIVATE_CHANNEL_ID)), index_channel_post))
     application.add_handler(MessageHandler(filters.PHOTO, handle_screenshot))
     application.add_error_handler(error_handler)
     
     # JOB QUEUE
     job_queue = application.job_queue
     job_queue.run_repeating(check_expiry_job, interval=60, first=10) # Check every 60s
+    job_queue.run_repeating(refresh_settings_job, interval=config.SETTINGS_REFRESH_INTERVAL, first=config.SETTINGS_REFRESH_INTERVAL)
+    job_queue.run_repeating(log_pool_stats_job, interval=600, first=600)
+    job_queue.run_repeating(purge_screenshots_job, interval=24 * 3600, first=300)
+    if paytm_utils.is_configured():
+        job_queue.run_repeating(reconcile_payments_job, interval=config.PAYTM_RECONCILE_INTERVAL, first=30)
     
     print("Bot is running... Go to Telegram and send /start")
     print(f"ℹ️ DIRECT MODE ACTIVE: Videos fetched from {config.PRIVATE_CHANNEL_ID} starting at msg {config.CHANNEL_START_ID}")
 
+    if config.BOT_MODE == "webhook":
+        # Telegram pushes updates to us; requests without the secret token header are rejected
+        print(f"🌐 Webhook mode on {config.WEBHOOK_LISTEN}:{config.WEBHOOK_PORT}/{config.WEBHOOK_PATH}")
+        application.run_webhook(
+            listen=config.WEBHOOK_LISTEN,
+            port=config.WEBHOOK_PORT,
+            url_path=config.WEBHOOK_PATH,
+            secret_token=config.WEBHOOK_SECRET,
+            webhook_url=f"{config.WEBHOOK_URL.rstrip('/')}/{config.WEBHOOK_PATH}",
+            bootstrap_retries=-1
+        )
+
     # Robust Polling Loop
-    while True:
+    while config.BOT_MODE != "webhook":
         try:
             print("🔄 connection started...")
             # Reduced timeout to 30 for shorter, more reliable cycles
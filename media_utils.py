@@ -0,0 +1,47 @@
+import hashlib
+import os
+import database as db
+
+# Images are uploaded to Telegram once; afterwards we send the returned file_id.
+# Entries are keyed by path + sha256, so a replaced file never reuses a stale file_id.
+
+# path -> (mtime_ns, size, sha256), so unchanged files aren't re-hashed on every send
+_digests = {}
+# (path, sha256) -> file_id
+_file_ids = {}
+
+def file_digest(path):
+    stat = os.stat(path)
+    cached = _digests.get(path)
+    if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        return cached[2]
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            sha.update(chunk)
+    digest = sha.hexdigest()
+    _digests[path] = (stat.st_mtime_ns, stat.st_size, digest)
+    return digest
+
+def get_file_id(path):
+    """Returns the Telegram file_id for this exact file content, or None if never uploaded."""
+    digest = file_digest(path)
+    file_id = _file_ids.get((path, digest))
+    if file_id is None:
+        file_id = db.get_media_file_id(path, digest)
+        if file_id:
+            _file_ids[(path, digest)] = file_id
+    return file_id
+
+def remember_file_id(path, file_id):
+    digest = file_digest(path)
+    _file_ids[(path, digest)] = file_id
+    db.save_media_file_id(path, digest, file_id)
+
+def forget(path):
+    """Drops every cached file_id for a path (file replaced, deleted or rejected by Telegram)."""
+    _digests.pop(path, None)
+    for key in [k for k in _file_ids if k[0] == path]:
+        del _file_ids[key]
+    db.invalidate_media(path)
@@ -0,0 +1,176 @@
+"""Versioned schema migrations and index bootstrap.
+
+Run explicitly, never on import: `python migrations.py` before deploying, and the bot
+calls run() once at startup. Each step runs once and then records its version in the
+settings collection, so restarts and extra processes skip straight to ensure_indexes().
+"""
+import json
+import os
+from datetime import datetime
+import pymongo
+import config
+from database import (
+    users_col, videos_col, orders_col, payouts_col, settings_col, media_col,
+    pending_payments_col, counters_col, screenshot_hashes_col, next_sequence, backfill_ledger, backfill_daily_stats
+)
+from screenshot_store import backfill_hashes
+
+def migrate_from_json():
+    db_file = "db.json"
+    if not os.path.exists(db_file): return
+    try:
+        with open(db_file, "r") as f:
+            data = json.load(f)
+            
+        if "users" in data and users_col.count_documents({}) == 0:
+            users_list = list(data["users"].values())
+            if users_list: users_col.insert_many(users_list)
+            
+        if "videos" in data and videos_col.count_documents({}) == 0:
+            if data["videos"]: videos_col.insert_many(data["videos"])
+            
+        if "orders" in data and orders_col.count_documents({}) == 0:
+            orders_list = list(data["orders"].values())
+            if orders_list: orders_col.insert_many(orders_list)
+            
+        if "payouts" in data and payouts_col.count_documents({}) == 0:
+            if data["payouts"]: payouts_col.insert_many(data["payouts"])
+            
+        os.rename(db_file, "db_migrated.json")
+    except Exception as e:
+        print(f"Migration error: {e}")
+
+def migrate_expiry_to_datetime():
+    # Older rows store subscription_expiry as an ISO string, which can't be range-queried
+    updates = []
+    for u in users_col.find({"subscription_expiry": {"$type": "string"}}, {"subscription_expiry": 1}):
+        try:
+            expiry = datetime.fromisoformat(u["subscription_expiry"])
+        except ValueError:
+            expiry = None
+        updates.append(pymongo.UpdateOne({"_id": u["_id"]}, {"$set": {"subscription_expiry": expiry}}))
+    if updates:
+        users_col.bulk_write(updates, ordered=False)
+        print(f"Migrated {len(updates)} expiry dates to datetime.")
+
+def migrate_normalize_user_ids():
+    # Old imports stored some user_id values as strings, and the non-atomic get_user
+    # could insert the same user twice. Both must go before the unique index can exist.
+    for u in users_col.find({"user_id": {"$type": "string"}}):
+        try:
+            user_id = int(u["user_id"])
+        except ValueError:
+            continue
+        if users_col.find_one({"user_id": user_id}, {"_id": 1}):
+            users_col.delete_one({"_id": u["_id"]})
+        else:
+            users_col.update_one({"_id": u["_id"]}, {"$set": {"user_id": user_id}})
+
+    duplicates = users_col.aggregate([
+        {"$sort": {"is_subscribed": -1, "subscription_expiry": -1}},
+        {"$group": {"_id": "$user_id", "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}}
+    ])
+    for dup in duplicates:
+        # Keep the document with the best subscription, drop the rest
+        users_col.delete_many({"_id": {"$in": dup["ids"][1:]}})
+
+def migrate_dates_to_datetime():
+    # joined_at / created_at were ISO strings; aggregation and range indexes need real dates
+    for collection, field in [(users_col, "joined_at"), (orders_col, "created_at")]:
+        updates = []
+        for doc in collection.find({field: {"$type": "string"}}, {field: 1}):
+            try:
+                value = datetime.fromisoformat(doc[field])
+            except ValueError:
+                continue
+            updates.append(pymongo.UpdateOne({"_id": doc["_id"]}, {"$set": {field: value}}))
+        if updates:
+            collection.bulk_write(updates, ordered=False)
+            print(f"Migrated {len(updates)} {field} values to datetime.")
+
+def migrate_sequence_counters():
+    # Start the counters after the highest id handed out by the old count_documents scheme,
+    # and renumber the duplicates it produced so the unique indexes can be built
+    as_int = lambda field: {"$convert": {"input": field, "to": "int", "onError": 0, "onNull": 0}}
+    for collection, name, field, to_seq in [(videos_col, "videos", "sequence_id", lambda v: v + 1),
+                                            (payouts_col, "payouts", "id", lambda v: v)]:
+        top = list(collection.aggregate([{"$group": {"_id": None, "max": {"$max": as_int(f"${field}")}}}]))
+        if top:
+            counters_col.update_one({"_id": name}, {"$max": {"seq": to_seq(top[0]["max"])}}, upsert=True)
+
+        duplicates = collection.aggregate([
+            {"$match": {field: {"$ne": None}}},
+            {"$group": {"_id": f"${field}", "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+            {"$match": {"count": {"$gt": 1}}}
+        ])
+        for dup in duplicates:
+            for doc_id in dup["ids"][1:]:
+                seq = next_sequence(name)
+                collection.update_one({"_id": doc_id}, {"$set": {field: seq - 1 if name == "videos" else str(seq)}})
+
+def drop_redundant_indexes():
+    # Expiry sweeps and the expiry-sorted dashboard both use (subscription_expiry, user_id)
+    if "subscription_expiry_1" in users_col.index_information():
+        users_col.drop_index("subscription_expiry_1")
+
+def ensure_ttl_index(collection, field, seconds):
+    # create_index refuses to change expireAfterSeconds on an existing index (IndexOptionsConflict),
+    # so a tuned TTL is applied in place with collMod
+    for info in collection.index_information().values():
+        if dict(info["key"]) == {field: 1}:
+            if info.get("expireAfterSeconds") != seconds:
+                collection.database.command("collMod", collection.name,
+                                            index={"keyPattern": {field: 1}, "expireAfterSeconds": seconds})
+            return
+    collection.create_index(field, expireAfterSeconds=seconds)
+
+def ensure_indexes():
+    # Hot paths: user lookups/expiry sweeps, order lookups/pending list, video paging.
+    # settings is only ever read by _id, which Mongo always indexes.
+    users_col.create_index("joined_at")
+    orders_col.create_index("order_id", unique=True)
+    orders_col.create_index("created_at")
+    orders_col.create_index([("status", 1), ("created_at", 1)])
+    users_col.create_index([("subscription_expiry", 1), ("user_id", 1)])
+    ensure_ttl_index(pending_payments_col, "created_at", config.PENDING_PAYMENT_TTL)
+    videos_col.create_index("message_id", unique=True, partialFilterExpression={"message_id": {"$type": "number"}})
+    media_col.create_index("path")
+    videos_col.create_index("sequence_id", unique=True)
+    payouts_col.create_index("id", unique=True)
+    orders_col.create_index("screenshot_sha256", sparse=True)
+    screenshot_hashes_col.create_index("bands")
+    users_col.create_index("user_id", unique=True)
+    users_col.create_index([("user_id", 1), ("subscription_expiry", 1)])
+
+# Append only: a step's number is stored in the database once it has run
+MIGRATIONS = [
+    (1, migrate_from_json),
+    (2, migrate_expiry_to_datetime),
+    (3, migrate_normalize_user_ids),
+    (4, migrate_dates_to_datetime),
+    (5, migrate_sequence_counters),
+    (6, backfill_ledger),
+    (7, backfill_daily_stats),
+    (8, backfill_hashes),
+    (9, drop_redundant_indexes),
+]
+
+def get_schema_version():
+    doc = settings_col.find_one({"_id": "schema"})
+    return doc["v"] if doc else 0
+
+def run():
+    """Applies pending migrations in order, then makes sure every index exists."""
+    version = get_schema_version()
+    for number, migration in MIGRATIONS:
+        if number <= version:
+            continue
+        print(f"Running migration {number}: {migration.__name__}")
+        migration()
+        settings_col.update_one({"_id": "schema"}, {"$set": {"v": number, "updated_at": datetime.now()}}, upsert=True)
+    ensure_indexes()
+
+if __name__ == "__main__":
+    run()
+    print(f"Schema at version {get_schema_version()}, indexes ensured.")
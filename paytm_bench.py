@@ -0,0 +1,71 @@
+import argparse
+import asyncio
+import os
+import time
+
+# Measures Paytm request signing: inline per call (what every request used to do on the
+# caller's thread), batched on the thread and process pools, and memoized status requests.
+# Usage: python paytm_bench.py --orders 2000 --workers 4
+# Without PAYTM_MERCHANT_KEY set, a throwaway key is used; no request leaves the machine.
+os.environ.setdefault("PAYTM_MERCHANT_KEY", "bench-key-16byte")
+os.environ.setdefault("PAYTM_MID", "BENCH00000000000000")
+
+import config
+import paytm_utils
+
+def timed(label, n, fn):
+    started = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - started
+    print(f"{label:<34} {elapsed:7.3f}s  {n / elapsed:9.0f} bodies/s")
+    return result
+
+def reset_pool(kind, workers):
+    if paytm_utils._pool:
+        paytm_utils._pool.shutdown()
+    paytm_utils._pool = None
+    config.PAYTM_SIGNING_POOL = kind
+    config.PAYTM_SIGNING_WORKERS = workers
+
+async def loop_stall(order_ids):
+    # Longest gap between event loop ticks while a batch is signed in the background
+    worst, ticking = 0.0, True
+
+    async def ticker():
+        nonlocal worst
+        last = time.perf_counter()
+        while ticking:
+            await asyncio.sleep(0)
+            now = time.perf_counter()
+            worst = max(worst, now - last)
+            last = now
+
+    task = asyncio.create_task(ticker())
+    await paytm_utils.prepare_status_requests(order_ids)
+    ticking = False
+    await task
+    return worst
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark Paytm request signing")
+    parser.add_argument("--orders", type=int, default=2000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2)
+    parser.add_argument("--chunk", type=int, default=config.PAYTM_SIGNING_CHUNK)
+    args = parser.parse_args()
+
+    order_ids = [f"bench{i:06d}" for i in range(args.orders)]
+    bodies = [paytm_utils._status_body(order_id) for order_id in order_ids]
+    print(f"Signing {args.orders} status bodies, {args.workers} workers, chunks of {args.chunk}\n")
+
+    timed("inline, one call each", args.orders, lambda: [paytm_utils._payload(b) for b in bodies])
+    for kind in ["thread", "process"]:
+        reset_pool(kind, args.workers)
+        paytm_utils.sign_many(bodies[:args.workers], chunk_size=1) # Start the workers outside the timing
+        timed(f"sign_many, {kind} pool", args.orders, lambda: paytm_utils.sign_many(bodies, chunk_size=args.chunk))
+
+    reset_pool("thread", args.workers)
+    config.PAYTM_SIGNATURE_CACHE_SIZE = max(config.PAYTM_SIGNATURE_CACHE_SIZE, args.orders)
+    stall = asyncio.run(loop_stall(order_ids))
+    print(f"{'event loop stall during batch':<34} {stall * 1000:7.1f}ms")
+    timed("memoized status requests", args.orders, lambda: [paytm_utils._status_request(o) for o in order_ids])
+    reset_pool("thread", args.workers)
@@ -0,0 +1,160 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# A local stand-in for the Paytm status / initiate APIs, for exercising paytm_utils without
+# touching the real gateway.
+# Usage: python paytm_stub.py --port 8765 --paid ORDER1:49 --flaky 2
+#   then run with PAYTM_STATUS_URL=http://127.0.0.1:8765/status (and PAYTM_TRANSACTION_URL=.../initiate)
+# or:    python paytm_stub.py --check
+#   which starts the stub in-process, runs the sync and async clients and the reconcile job
+#   against it, and exits non-zero if any expectation fails.
+# Without PAYTM_MERCHANT_KEY set, a throwaway key signs the requests; the stub never checks it.
+os.environ.setdefault("PAYTM_MERCHANT_KEY", "stub-key-16bytes")
+os.environ.setdefault("PAYTM_MID", "STUB0000000000000000")
+
+import paytm_utils
+
+class StubGateway(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, paid=None, flaky=0, delay=0.0):
+        super().__init__(address, StubHandler)
+        self.paid = paid or {} # order_id -> amount Paytm "received"
+        self.flaky = flaky # How many requests fail with 503 before the gateway recovers
+        self.delay = delay # Seconds every response takes
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0 # Most requests ever handled at the same time
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+class StubHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def reply(self, code, payload=None):
+        body = json.dumps(payload or {}).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        gateway = self.server
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        with gateway.lock:
+            gateway.requests += 1
+            gateway.in_flight += 1
+            gateway.max_in_flight = max(gateway.max_in_flight, gateway.in_flight)
+            flaky = gateway.flaky > 0
+            gateway.flaky -= flaky
+        time.sleep(gateway.delay)
+        with gateway.lock:
+            gateway.in_flight -= 1
+        if flaky:
+            return self.reply(503)
+
+        order_id = request.get("body", {}).get("orderId")
+        if self.path.startswith("/initiate"):
+            return self.reply(200, {"body": {"resultInfo": {"resultStatus": "S"}, "txnToken": f"token-{order_id}"}})
+        if order_id in gateway.paid:
+            return self.reply(200, {"body": {
+                "resultInfo": {"resultStatus": "TXN_SUCCESS", "resultCode": "01", "resultMsg": "Txn Success"},
+                "orderId": order_id, "txnId": f"txn-{order_id}", "txnAmount": f"{gateway.paid[order_id]:.2f}"
+            }})
+        return self.reply(200, {"body": {
+            "resultInfo": {"resultStatus": "PENDING", "resultCode": "402", "resultMsg": "Looks like the payment is not complete."},
+            "orderId": order_id
+        }})
+
+def serve(port=0, **kwargs):
+    gateway = StubGateway(("127.0.0.1", port), **kwargs)
+    threading.Thread(target=gateway.serve_forever, daemon=True).start()
+    return gateway
+
+def check():
+    """Runs the clients and reconcile_pending_orders against an in-process stub. Returns the
+    number of failed expectations."""
+    failures = []
+
+    def expect(label, ok, detail=""):
+        print(f"{'ok  ' if ok else 'FAIL'} {label}" + (f" ({detail})" if detail else ""))
+        if not ok:
+            failures.append(label)
+
+    gateway = serve(paid={"paid-1": 49.0, "paid-2": 99.0, "short-1": 10.0}, flaky=2)
+    urls = {"status_url": f"{gateway.url}/status", "transaction_url": f"{gateway.url}/initiate", "retries": 2}
+
+    client = paytm_utils.PaytmClient(**urls)
+    status = paytm_utils.result_status(client.transaction_status("paid-1"))
+    expect("sync status retries through two 503s", status == "TXN_SUCCESS" and gateway.requests == 3,
+           f"{status}, {gateway.requests} requests")
+    token = client.initiate_transaction("paid-2", 49, 1)
+    expect("sync initiate returns the txn token", token == "token-paid-2", token)
+
+    async def run_async():
+        client = paytm_utils.AsyncPaytmClient(**urls)
+        gateway.delay = 0.2
+        before = gateway.requests
+        started = time.time()
+        results = await asyncio.gather(*(client.transaction_status(f"order-{i}") for i in range(10)))
+        elapsed = time.time() - started
+        states = {paytm_utils.result_status(r) for r in results}
+        expect("async status checks run concurrently", states == {"PENDING"} and elapsed < 1.0,
+               f"10 checks at 0.2s took {elapsed:.2f}s -> {states}")
+        expect("async sends one request per check", gateway.requests - before == 10, f"{gateway.requests - before} requests")
+
+        # reconcile_pending_orders with the two database calls it makes replaced by stubs
+        orders = [{"order_id": f"order-{i}", "user_id": i, "amount": 49} for i in range(6)]
+        orders += [{"order_id": "paid-1", "user_id": 100, "amount": 49},
+                   {"order_id": "paid-2", "user_id": 101, "amount": 99},
+                   {"order_id": "short-1", "user_id": 102, "amount": 49}]
+        approved, failed = [], []
+        originals = paytm_utils.db.get_pending_orders_since, paytm_utils.db.approve_order, paytm_utils.db.fail_order
+        paytm_utils.db.get_pending_orders_since = lambda since: orders
+        paytm_utils.db.approve_order = lambda order_id, via="admin": approved.append((order_id, via)) or {"order_id": order_id}
+        paytm_utils.db.fail_order = failed.append
+        gateway.max_in_flight = 0
+        before = gateway.requests
+        try:
+            result = await paytm_utils.reconcile_pending_orders(client, concurrency=3)
+        finally:
+            paytm_utils.db.get_pending_orders_since, paytm_utils.db.approve_order, paytm_utils.db.fail_order = originals
+        await client.close()
+
+        expect("reconcile approves the orders paid in full", sorted(approved) == [("paid-1", "gateway"), ("paid-2", "gateway")]
+               and sorted(o["order_id"] for o in result) == ["paid-1", "paid-2"] and not failed, approved)
+        expect("reconcile checks every order once", gateway.requests - before == len(orders), f"{gateway.requests - before} requests")
+        expect("reconcile stays within its concurrency", gateway.max_in_flight == 3, f"at most {gateway.max_in_flight} in flight")
+
+    asyncio.run(run_async())
+    gateway.shutdown()
+    print(f"{len(failures)} of the checks failed." if failures else "All checks passed.")
+    return len(failures)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local stub of the Paytm status/initiate APIs")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--paid", action="append", default=[], help="ORDER_ID:AMOUNT reported as TXN_SUCCESS")
+    parser.add_argument("--flaky", type=int, default=0, help="answer the first N requests with 503")
+    parser.add_argument("--delay", type=float, default=0.0)
+    parser.add_argument("--check", action="store_true", help="run the clients against an in-process stub and exit")
+    args = parser.parse_args()
+
+    if args.check:
+        sys.exit(1 if check() else 0)
+    else:
+        paid = {order_id: float(amount) for order_id, amount in (p.split(":", 1) for p in args.paid)}
+        gateway = StubGateway(("127.0.0.1", args.port), paid=paid, flaky=args.flaky, delay=args.delay)
+        print(f"Stub Paytm gateway on {gateway.url} (/status, /initiate)")
+        gateway.serve_forever()
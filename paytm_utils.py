@@ -1,63 +1,29 @@
-from paytmchecksum import PaytmChecksum
-import config
-import requests
+import asyncio
 import json
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import config
+import database as db
 
 def generate_checksum(order_id, txn_amount, customer_id):
     """
     Generates Paytm Checksum for transaction.
     """
-    paytmParams = dict()
-
-    paytmParams["body"] = {
-        "requestType": "Payment",
-        "mid": config.PAYTM_MID,
-        "websiteName": config.PAYTM_WEBSITE,
-        "orderId": order_id,
-        "callbackUrl": config.PAYTM_CALLBACK_URL,
-        "txnAmount": {
-            "value": str(txn_amount),
-            "currency": "INR",
-        },
-        "userInfo": {
-            "custId": customer_id,
-        },
-    }
-
-    # Generate checksum by parameters we have in body
-    # Find your Merchant Key in your Paytm Dashboard at https://dashboard.paytm.com/next/apikeys
-    checksum = PaytmChecksum.generateSignature(json.dumps(paytmParams["body"]), config.PAYTM_MERCHANT_KEY)
-
-    paytmParams["head"] = {
-        "signature": checksum
-    }
-
-    return paytmParams
+    body = _initiate_body(order_id, txn_amount, customer_id)
+    return {"body": body, "head": {"signature": _sign(body)}}
 
 def verify_transaction_status(order_id):
     """
     Checks the status of the transaction via Paytm API.
     """
-    paytmParams = dict()
-
-    paytmParams["body"] = {
-        "mid": config.PAYTM_MID,
-        "orderId": order_id,
-    }
-
-    # Generate checksum for status check
-    checksum = PaytmChecksum.generateSignature(json.dumps(paytmParams["body"]), config.PAYTM_MERCHANT_KEY)
-
-    paytmParams["head"] = {
-        "signature": checksum
-    }
-
-    url = config.PAYTM_STATUS_URL
-
-    post_data = json.dumps(paytmParams)
-    response = requests.post(url, data=post_data, headers={"Content-type": "application/json"}).json()
-    
-    return response
+    return get_client().transaction_status(order_id)
 
 def create_payment_link(order_id, txn_amount, customer_id, customer_mobile=None, description="Subscription"):
     """
@@ -92,32 +58,257 @@ def create_payment_link(order_id, txn_amount, customer_id, customer_mobile=None,
     pass
 
 def initiate_transaction(order_id, txn_amount, customer_id):
-    paytmParams = dict()
-    paytmParams["body"] = {
+    return get_client().initiate_transaction(order_id, txn_amount, customer_id)
+
+def _callback_url():
+    # In auto mode Paytm sends the payer back to server.py, which confirms the order right away
+    if config.PAYMENT_MODE == "auto":
+        return f"{config.PAYMENT_PAGE_BASE_URL.rstrip('/')}/paytm/callback"
+    return config.PAYTM_CALLBACK_URL
+
+def _status_body(order_id):
+    return {"mid": config.PAYTM_MID, "orderId": order_id}
+
+def _initiate_body(order_id, txn_amount, customer_id):
+    return {
         "requestType": "Payment",
         "mid": config.PAYTM_MID,
         "websiteName": config.PAYTM_WEBSITE,
         "orderId": order_id,
-        "callbackUrl": config.PAYTM_CALLBACK_URL,
+        "callbackUrl": _callback_url(),
         "txnAmount": {
             "value": str(txn_amount),
             "currency": "INR",
         },
         "userInfo": {
-            "custId": customer_id,
+            "custId": str(customer_id),
         },
     }
-    
-    checksum = PaytmChecksum.generateSignature(json.dumps(paytmParams["body"]), config.PAYTM_MERCHANT_KEY)
-    paytmParams["head"] = {
-        "signature": checksum
-    }
 
-    url = f"{config.PAYTM_TRANSACTION_URL}?mid={config.PAYTM_MID}&orderId={order_id}"
-    
-    response = requests.post(url, data=json.dumps(paytmParams), headers={"Content-type": "application/json"}).json()
-    
+# --- Signing ---
+# generateSignature is AES over a fresh salt: pure CPU. Async callers run it on a worker pool
+# instead of the event loop, batches are signed in chunks (one pool task per chunk), and
+# signed status requests are memoized per order: the body never changes, and a sweep asks
+# about the same pending orders every few minutes.
+_pool = None
+_pool_lock = threading.Lock()
+_status_cache = OrderedDict()
+_status_cache_lock = threading.Lock()
+
+def _signing_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                executor = ProcessPoolExecutor if config.PAYTM_SIGNING_POOL == "process" else ThreadPoolExecutor
+                _pool = executor(max_workers=config.PAYTM_SIGNING_WORKERS)
+    return _pool
+
+def _sign(body):
+    # Imported here: paytmchecksum needs pycryptodome, which manual-payment setups may not install,
+    # and the bot and dashboard import this module in every payment mode
+    from paytmchecksum import PaytmChecksum
+    return PaytmChecksum.generateSignature(json.dumps(body), config.PAYTM_MERCHANT_KEY)
+
+def _payload(body):
+    # Serialized once, here: the gateway checks the signature against exactly these body bytes
+    return json.dumps({"body": body, "head": {"signature": _sign(body)}})
+
+def _sign_chunk(bodies):
+    return [_payload(body) for body in bodies]
+
+def _chunks(bodies, chunk_size):
+    chunk_size = chunk_size or config.PAYTM_SIGNING_CHUNK
+    return [bodies[i:i + chunk_size] for i in range(0, len(bodies), chunk_size)]
+
+def sign_many(bodies, chunk_size=None):
+    """Signs request bodies on the signing pool. Returns the serialized requests, in order."""
+    return [payload for chunk in _signing_pool().map(_sign_chunk, _chunks(bodies, chunk_size)) for payload in chunk]
+
+async def sign_many_async(bodies, chunk_size=None):
+    """sign_many without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    chunks = await asyncio.gather(*(
+        loop.run_in_executor(_signing_pool(), _sign_chunk, chunk) for chunk in _chunks(bodies, chunk_size)
+    ))
+    return [payload for chunk in chunks for payload in chunk]
+
+def _cached_status_request(order_id):
+    with _status_cache_lock:
+        payload = _status_cache.get(order_id)
+        if payload is not None:
+            _status_cache.move_to_end(order_id)
+        return payload
+
+def _cache_status_request(order_id, payload):
+    with _status_cache_lock:
+        _status_cache[order_id] = payload
+        _status_cache.move_to_end(order_id)
+        while len(_status_cache) > config.PAYTM_SIGNATURE_CACHE_SIZE:
+            _status_cache.popitem(last=False)
+
+def _status_request(order_id):
+    payload = _cached_status_request(order_id)
+    if payload is None:
+        payload = _payload(_status_body(order_id))
+        _cache_status_request(order_id, payload)
+    return payload
+
+async def prepare_status_requests(order_ids):
+    """Signs the status requests of all order_ids that aren't memoized yet, as one batch."""
+    missing = [order_id for order_id in order_ids if _cached_status_request(order_id) is None]
+    payloads = await sign_many_async([_status_body(order_id) for order_id in missing]) if missing else []
+    for order_id, payload in zip(missing, payloads):
+        _cache_status_request(order_id, payload)
+    return dict(zip(missing, payloads))
+
+async def _status_request_async(order_id):
+    return _cached_status_request(order_id) or (await prepare_status_requests([order_id]))[order_id]
+
+def _txn_token(response):
     if "body" in response and "txnToken" in response["body"]:
         return response["body"]["txnToken"]
     return None
 
+# Gateway hiccups worth another try; anything else is an answer
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+class PaytmClient:
+    """Paytm API over one keep-alive session, with timeouts and bounded retries."""
+
+    def __init__(self, status_url=None, transaction_url=None, timeout=None, retries=None, pool_size=None):
+        self.status_url = status_url or config.PAYTM_STATUS_URL
+        self.transaction_url = transaction_url or config.PAYTM_TRANSACTION_URL
+        self.timeout = timeout or config.PAYTM_TIMEOUT
+        retry = Retry(
+            total=config.PAYTM_RETRIES if retries is None else retries,
+            backoff_factor=0.5,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=None, # Both calls are safe to repeat: status is a read, initiate is keyed by orderId
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(max_retries=retry, pool_maxsize=pool_size or config.PAYTM_POOL_SIZE)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def _post(self, url, payload):
+        response = self.session.post(url, data=payload, headers={"Content-type": "application/json"}, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def transaction_status(self, order_id):
+        return self._post(self.status_url, _status_request(order_id))
+
+    def initiate_transaction(self, order_id, txn_amount, customer_id):
+        url = f"{self.transaction_url}?mid={config.PAYTM_MID}&orderId={order_id}"
+        return _txn_token(self._post(url, _payload(_initiate_body(order_id, txn_amount, customer_id))))
+
+    def close(self):
+        self.session.close()
+
+class AsyncPaytmClient:
+    """Same API as PaytmClient for the bot's event loop, on a pooled httpx.AsyncClient."""
+
+    def __init__(self, status_url=None, transaction_url=None, timeout=None, retries=None, pool_size=None):
+        self.status_url = status_url or config.PAYTM_STATUS_URL
+        self.transaction_url = transaction_url or config.PAYTM_TRANSACTION_URL
+        self.retries = config.PAYTM_RETRIES if retries is None else retries
+        pool_size = pool_size or config.PAYTM_POOL_SIZE
+        self.client = httpx.AsyncClient(
+            timeout=timeout or config.PAYTM_TIMEOUT,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        )
+
+    async def _post(self, url, payload):
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries
+            try:
+                response = await self.client.post(url, content=payload, headers={"Content-type": "application/json"})
+            except httpx.TransportError:
+                if last:
+                    raise
+            else:
+                if response.status_code not in RETRY_STATUSES or last:
+                    response.raise_for_status()
+                    return response.json()
+            await asyncio.sleep(0.5 * 2 ** attempt)
+
+    async def transaction_status(self, order_id):
+        return await self._post(self.status_url, await _status_request_async(order_id))
+
+    async def initiate_transaction(self, order_id, txn_amount, customer_id):
+        url = f"{self.transaction_url}?mid={config.PAYTM_MID}&orderId={order_id}"
+        payload = (await sign_many_async([_initiate_body(order_id, txn_amount, customer_id)]))[0]
+        return _txn_token(await self._post(url, payload))
+
+    async def close(self):
+        await self.client.aclose()
+
+_client = None
+_async_client = None
+_async_client_loop = None
+
+def get_client():
+    global _client
+    if _client is None:
+        _client = PaytmClient()
+    return _client
+
+def get_async_client():
+    # httpx.AsyncClient is tied to the loop it was created on; polling restarts get a new loop
+    global _async_client, _async_client_loop
+    loop = asyncio.get_running_loop()
+    if _async_client is None or _async_client_loop is not loop:
+        _async_client = AsyncPaytmClient()
+        _async_client_loop = loop
+    return _async_client
+
+def is_configured():
+    return bool(config.PAYTM_MID and config.PAYTM_MERCHANT_KEY)
+
+def payment_page_url(order_id):
+    """Link for the Pay button; server.py's /pay page forwards it to Paytm's checkout."""
+    return f"{config.PAYMENT_PAGE_BASE_URL.rstrip('/')}/pay/{order_id}"
+
+def result_status(response):
+    return response.get("body", {}).get("resultInfo", {}).get("resultStatus")
+
+def is_paid_in_full(order, response):
+    if result_status(response) != "TXN_SUCCESS":
+        return False
+    try:
+        return float(response["body"].get("txnAmount", 0)) >= float(order["amount"])
+    except (TypeError, ValueError):
+        return False
+
+def settle(order, response):
+    """Applies a status response to an order: approves it if paid in full, fails an unpaid
+    gateway order Paytm gave up on. Returns the approved order or None."""
+    if is_paid_in_full(order, response):
+        # approve_order is idempotent, so an admin approving at the same moment is harmless
+        return db.approve_order(order["order_id"], via="gateway")
+    if result_status(response) == "TXN_FAILURE":
+        db.fail_order(order["order_id"])
+    return None
+
+async def reconcile_pending_orders(client, concurrency=None, max_age=None):
+    """Asks Paytm about every recent order still waiting for approval, at most `concurrency` at
+    a time, and approves the ones it reports as paid in full. Returns the approved orders."""
+    since = datetime.now() - timedelta(seconds=max_age or config.PAYTM_RECONCILE_MAX_AGE)
+    orders = await asyncio.to_thread(db.get_pending_orders_since, since)
+    # Sign everything up front in one batch; each check below then hits the memo
+    await prepare_status_requests([order["order_id"] for order in orders])
+    semaphore = asyncio.Semaphore(concurrency or config.PAYTM_RECONCILE_CONCURRENCY)
+
+    async def reconcile(order):
+        async with semaphore:
+            try:
+                response = await client.transaction_status(order["order_id"])
+            except (httpx.HTTPError, ValueError) as e:
+                logging.warning("Paytm status check failed for %s: %s", order["order_id"], e)
+                return None
+        return await asyncio.to_thread(settle, order, response)
+
+    results = await asyncio.gather(*(reconcile(o) for o in orders))
+    return [order for order in results if order]
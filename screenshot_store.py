@@ -0,0 +1,145 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+from datetime import datetime, timedelta
+from PIL import Image
+import config
+import database as db
+
+# Payment screenshots are stored once per content, as static/screenshots/<aa>/<sha256>.jpg,
+# with a small JPEG thumbnail under screenshots/thumbs/ for the dashboard list. Orders keep
+# the relative paths plus the hash, so a resubmitted image is stored once and flagged.
+#
+# Exact hashes miss a re-saved, cropped or recompressed copy, so every screenshot also gets a
+# 64-bit difference hash (dHash) in the screenshot_hashes collection. Near-duplicates are
+# found by Hamming distance through a banded index: the hash is split into 8 one-byte bands,
+# and two hashes within distance 7 always share at least one band exactly, so an indexed
+# $in on the bands yields every candidate without scanning the collection.
+
+STATIC_ROOT = os.path.dirname(config.UPLOAD_FOLDER) # Paths on orders are relative to this
+
+class _HashingWriter:
+    """Sink for File.download_to_memory: hashes the bytes while writing them to a temp file."""
+
+    def __init__(self, directory):
+        self.sha = hashlib.sha256()
+        self.file = tempfile.NamedTemporaryFile(dir=directory, suffix=".part", delete=False)
+
+    def write(self, data):
+        self.sha.update(data)
+        return self.file.write(data)
+
+def _relative_path(digest, thumb=False):
+    folder = os.path.basename(config.UPLOAD_FOLDER)
+    return "/".join([folder] + (["thumbs"] if thumb else []) + [digest[:2], f"{digest}.jpg"])
+
+def _absolute_path(relative_path):
+    return os.path.join(STATIC_ROOT, *relative_path.split("/"))
+
+def _dhash(img):
+    # One bit per horizontally adjacent pixel pair of a 9x8 grayscale copy: brighter or not
+    pixels = list(img.convert("L").resize((9, 8), Image.LANCZOS).getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = bits << 1 | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return f"{bits:016x}"
+
+def _process_image(src, thumb_dest=None):
+    """Writes the thumbnail (if thumb_dest is given) and returns (thumbnail written, dHash)."""
+    try:
+        with Image.open(src) as img:
+            # thumbnail() lets the JPEG decoder downscale while decoding, so this stays cheap
+            img.thumbnail((config.SCREENSHOT_THUMB_SIZE, config.SCREENSHOT_THUMB_SIZE))
+            if thumb_dest:
+                os.makedirs(os.path.dirname(thumb_dest), exist_ok=True)
+                img.convert("RGB").save(thumb_dest, "JPEG", quality=70)
+            return True, _dhash(img)
+    except OSError as e:
+        print(f"⚠️ Could not process screenshot {src}: {e}")
+        return False, None
+
+def hamming(a, b):
+    return bin(int(a, 16) ^ int(b, 16)).count("1")
+
+def _bands(phash):
+    return [f"{i}:{phash[2 * i:2 * i + 2]}" for i in range(8)]
+
+def find_similar(phash):
+    """Earlier screenshots within SCREENSHOT_MATCH_DISTANCE of phash, closest first."""
+    matches = []
+    for candidate in db.find_screenshot_candidates(_bands(phash)):
+        distance = hamming(phash, candidate["phash"])
+        if distance <= config.SCREENSHOT_MATCH_DISTANCE:
+            matches.append({"order_id": candidate["_id"], "user_id": candidate["user_id"], "distance": distance})
+    matches.sort(key=lambda m: m["distance"])
+    return matches[:config.SCREENSHOT_MAX_MATCHES]
+
+def index_screenshot(order_id, user_id, phash, created_at=None):
+    db.save_screenshot_hash(order_id, user_id, phash, _bands(phash), created_at or datetime.now())
+
+def _store(tmp_path, digest):
+    path = _relative_path(digest)
+    dest = _absolute_path(path)
+    if os.path.exists(dest):
+        os.remove(tmp_path) # Same image already stored
+    else:
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        os.replace(tmp_path, dest)
+
+    thumb = _relative_path(digest, thumb=True)
+    thumb_exists = os.path.exists(_absolute_path(thumb))
+    processed, phash = _process_image(dest, None if thumb_exists else _absolute_path(thumb))
+    if not (thumb_exists or processed):
+        thumb = None
+    return {"screenshot_path": path, "screenshot_thumb": thumb, "screenshot_sha256": digest, "screenshot_phash": phash}
+
+async def save_from_telegram(file):
+    """Downloads a telegram.File into the store. Returns the screenshot fields for the order."""
+    os.makedirs(config.UPLOAD_FOLDER, exist_ok=True)
+    writer = _HashingWriter(config.UPLOAD_FOLDER)
+    try:
+        await file.download_to_memory(writer)
+    except Exception:
+        writer.file.close()
+        os.remove(writer.file.name)
+        raise
+    writer.file.close()
+    return await asyncio.to_thread(_store, writer.file.name, writer.sha.hexdigest())
+
+def backfill_hashes():
+    """Perceptual hashes for screenshots stored before the hash index existed."""
+    count = 0
+    for order in db.get_unhashed_screenshots():
+        src = _absolute_path(order["screenshot_path"])
+        if not os.path.exists(src):
+            continue
+        _, phash = _process_image(src)
+        if phash:
+            db.set_order_phash(order["order_id"], phash)
+            index_screenshot(order["order_id"], order["user_id"], phash, order.get("created_at"))
+            count += 1
+    if count:
+        print(f"Hashed {count} existing screenshots.")
+
+def _remove(relative_path):
+    try:
+        os.remove(_absolute_path(relative_path))
+    except FileNotFoundError:
+        pass
+
+def purge_expired(retention_days=None):
+    """Deletes screenshot files of settled orders older than the retention window. A file stays
+    while any pending or recent order still uses the same image. Returns the orders purged."""
+    cutoff = datetime.now() - timedelta(days=retention_days or config.SCREENSHOT_RETENTION_DAYS)
+    orders = db.get_expired_screenshots(cutoff)
+    for order in orders:
+        digest = order.get("screenshot_sha256")
+        if digest and db.screenshot_in_use(digest, cutoff):
+            continue
+        _remove(order["screenshot_path"])
+        if order.get("screenshot_thumb"):
+            _remove(order["screenshot_thumb"])
+    db.clear_screenshots([order["order_id"] for order in orders])
+    return len(orders)
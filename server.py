@@ -1,13 +1,16 @@
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, render_template, jsonify, request, abort, make_response
 import database as db
+import media_utils
+import broadcaster
 import os
 import threading
+import uuid
 import logging
 from flask_cors import CORS
 import requests
-import json
 import config
 import time
+from datetime import datetime
 
 # Configure logging to be less verbose for Flask
 log = logging.getLogger('werkzeug')
@@ -40,9 +43,41 @@ def safe_send_telegram(endpoint, json_data=None, data=None, files=None):
             time.sleep(1)
     return None
 
+def is_file_id_error(response):
+    # e.g. 400 "Bad Request: wrong file identifier/HTTP URL specified"
+    if response is None or response.status_code != 400:
+        return False
+    try:
+        return "file" in response.json().get("description", "").lower()
+    except ValueError:
+        return False
+
+def send_photo_cached(chat_id, photo_path):
+    """sendPhoto that uploads a file only once and reuses Telegram's file_id afterwards."""
+    file_id = media_utils.get_file_id(photo_path)
+    if file_id:
+        response = safe_send_telegram("sendPhoto", data={"chat_id": chat_id, "photo": file_id})
+        if response is not None and response.status_code == 200:
+            return response
+        if not is_file_id_error(response):
+            # Blocked bot, flood control, network trouble: the cached file_id is still good
+            return response
+        media_utils.forget(photo_path)
+
+    with open(photo_path, 'rb') as f:
+        response = safe_send_telegram("sendPhoto", data={"chat_id": chat_id}, files={"photo": f})
+    if response is not None and response.status_code == 200:
+        media_utils.remember_file_id(photo_path, response.json()['result']['photo'][-1]['file_id'])
+    return response
+
 app = Flask(__name__)
 CORS(app)
 
+# The dashboard and its /api routes have no login, so they must stay off the internet. The two
+# routes Paytm and payers need live on their own app and port, the only one to expose publicly
+# (gunicorn server:payments_app).
+payments_app = Flask(__name__)
+
 # Helper to pass bot reference if needed (complex in threads, so we use DB only)
 # Bot notifications on approval will be handled by Main Bot polling DB? 
 # Or server updates DB, and Main Bot logic handles user entry?
@@ -57,34 +92,93 @@ CORS(app)
 
 @app.route('/')
 def index():
-    users = db.get_all_users()
-    orders = db.get_pending_orders()
+    # Only O(1) reads here; tables are fetched lazily by the page from the JSON endpoints below
+    db.refresh_settings() # Other workers may have edited settings
     stats = db.get_earnings_stats()
-    analytics = db.get_daily_user_analytics()
     main_menu_text = db.get_main_menu_text() or ""
     pricing_plans = db.get_pricing_plans()
     
+    return render_template('index.html', stats=stats, financials=get_financials(stats), main_menu_text=main_menu_text, pricing_plans=pricing_plans)
+
+def get_financials(stats):
     # Financials (40% Yash, 60% Abhishek)
     total_earnings = stats['total']
     yash_share = total_earnings * 0.40
     abhishek_share = total_earnings * 0.60
     
-    total_paid_yash = db.get_total_paid()
+    total_paid_yash = stats['paid'] # Same ledger read as the earnings
     pending_yash = yash_share - total_paid_yash
-    
-    payouts = db.get_payouts()
-    # Sort payouts new to old
-    payouts.sort(key=lambda x: x['date'], reverse=True)
 
-    financials = {
+    return {
         "yash_share": yash_share,
         "abhishek_share": abhishek_share,
         "total_paid": total_paid_yash,
-        "pending": pending_yash,
-        "payouts": payouts
+        "pending": pending_yash
     }
 
-    return render_template('index.html', users=users, orders=orders, stats=stats, financials=financials, analytics=analytics, main_menu_text=main_menu_text, pricing_plans=pricing_plans)
+def to_json(doc):
+    """Mongo document -> JSON-safe dict (dates as ISO strings)."""
+    return {k: v.isoformat() if isinstance(v, datetime) else v for k, v in doc.items() if k != "_id"}
+
+def page_args(default_limit=50):
+    after = request.args.get("after") or None
+    try:
+        limit = int(request.args.get("limit", default_limit))
+        if limit < 1:
+            raise ValueError("limit must be positive")
+        if after:
+            db.decode_cursor(after)
+    except ValueError as e:
+        abort(make_response(jsonify({"status": "error", "message": str(e)}), 400))
+    return after, min(limit, 200)
+
+@app.route('/api/stats', methods=['GET'])
+def get_stats():
+    stats = db.get_earnings_stats()
+    return jsonify({"status": "success", "stats": stats, "financials": get_financials(stats)})
+
+@app.route('/api/users', methods=['GET'])
+def list_users():
+    # ?sort=id|expiry&q=<user_id>&after=<cursor>&limit=50
+    after, limit = page_args()
+    user_id = request.args.get("q", "").strip()
+    if user_id and not user_id.isdigit():
+        return jsonify({"status": "error", "message": "Search by numeric user id"}), 400
+    try:
+        rows, next_cursor = db.list_users_page(after, limit, sort=request.args.get("sort", "id"), user_id=user_id or None)
+    except ValueError as e:
+        # e.g. a cursor from another sort order
+        return jsonify({"status": "error", "message": str(e)}), 400
+    return jsonify({"status": "success", "users": [to_json(u) for u in rows], "next": next_cursor})
+
+@app.route('/api/orders/pending', methods=['GET'])
+def list_pending_orders():
+    after, limit = page_args()
+    try:
+        rows, next_cursor = db.list_pending_orders_page(after, limit)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    return jsonify({"status": "success", "orders": [to_json(o) for o in rows], "next": next_cursor})
+
+@app.route('/api/payouts', methods=['GET'])
+def list_payouts():
+    after, limit = page_args(20)
+    try:
+        rows, next_cursor = db.list_payouts_page(after, limit)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    return jsonify({"status": "success", "payouts": [to_json(p) for p in rows], "next": next_cursor})
+
+@app.route('/api/analytics', methods=['GET'])
+def analytics():
+    # ?start=YYYY-MM-DD&end=YYYY-MM-DD, both optional and inclusive
+    rows = db.get_daily_analytics(request.args.get("start"), request.args.get("end"))
+    return jsonify({"status": "success", "analytics": rows})
+
+@app.route('/api/pool_stats', methods=['GET'])
+def get_pool_stats():
+    # Per worker process: each gunicorn worker has its own client and pool
+    return jsonify({"status": "success", "pool": db.pool_stats()})
 
 @app.route('/api/update_main_menu', methods=['POST'])
 def update_main_menu():
@@ -117,29 +211,61 @@ def mark_paid():
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
+@payments_app.route('/pay/<order_id>', methods=['GET'])
+def pay(order_id):
+    # Telegram URL buttons can only GET; Paytm's checkout wants a POST carrying the txnToken
+    order = db.get_order(order_id)
+    if not order or order.get("status") != "AWAITING_PAYMENT" or not order.get("txn_token"):
+        return "This payment link is no longer valid. Please choose a plan again in the bot.", 404
+    return render_template('pay.html', action=config.PAYTM_PAYMENT_PAGE_URL, mid=config.PAYTM_MID,
+                           order_id=order_id, txn_token=order["txn_token"])
+
+@payments_app.route('/paytm/callback', methods=['POST'])
+def paytm_callback():
+    # The posted form is not trusted: the order is only settled from a server-side status check
+    order_id = request.form.get("ORDERID")
+    order = db.get_order(order_id) if order_id else None
+    if not order:
+        return "Unknown order.", 404
+    approved = None
+    if order.get("status") != "SUCCESS":
+        import paytm_utils # Only this route talks to Paytm; the dashboard boots without its stack
+        try:
+            approved = paytm_utils.settle(order, paytm_utils.verify_transaction_status(order_id))
+        except Exception as e:
+            print(f"Paytm status check failed for {order_id}: {e}")
+    if approved:
+        db.clear_pending_payment(approved["user_id"])
+        safe_send_telegram("sendMessage", json_data={
+            "chat_id": approved["user_id"],
+            "text": "✅ **Payment confirmed!** Your subscription is active. Use /start to continue.",
+            "parse_mode": "Markdown"
+        })
+    if approved or order.get("status") == "SUCCESS":
+        return "✅ Payment confirmed. You can go back to Telegram."
+    return "⏳ Payment not confirmed yet. Go back to Telegram; access is activated as soon as Paytm confirms it."
+
 @app.route('/api/approve/<order_id>', methods=['POST'])
 def approve(order_id):
-    success = db.approve_order(order_id)
-    if success:
+    order = db.approve_order(order_id)
+    if order:
         # Notify User
-        order = db.get_order(order_id)
-        if order:
-            try:
-                user_id = order['user_id']
-                safe_send_telegram(
-                    "sendMessage",
-                    json_data={
-                        "chat_id": user_id,
-                        "text": "✅ **Your subscription has been APPROVED!**\n\nYou can now access the premium content. Use /start if needed.",
-                        "parse_mode": "Markdown"
-                    }
-                )
-                
-                # Check if we should auto-trigger video interface? 
-                # We can't easily trigger the python function from here, but the user is subscribed now.
-                # A simple message is enough.
-            except Exception as e:
-                print(f"Failed to notify user: {e}")
+        try:
+            user_id = order['user_id']
+            safe_send_telegram(
+                "sendMessage",
+                json_data={
+                    "chat_id": user_id,
+                    "text": "✅ **Your subscription has been APPROVED!**\n\nYou can now access the premium content. Use /start if needed.",
+                    "parse_mode": "Markdown"
+                }
+            )
+            
+            # Check if we should auto-trigger video interface? 
+            # We can't easily trigger the python function from here, but the user is subscribed now.
+            # A simple message is enough.
+        except Exception as e:
+            print(f"Failed to notify user: {e}")
 
         return jsonify({"status": "success"})
     return jsonify({"status": "error", "message": "Order not found or already processed"}), 400
@@ -164,18 +290,17 @@ def reject(order_id):
                 )
                 
                 # Send QR Code again
-                with open(config.QR_CODE_PATH, 'rb') as f:
-                    safe_send_telegram(
-                        "sendPhoto",
-                        data={"chat_id": user_id},
-                        files={"photo": f}
-                    )
+                send_photo_cached(user_id, config.QR_CODE_PATH)
             except Exception as e:
                 print(f"Failed to notify user: {e}")
 
         return jsonify({"status": "success"})
     return jsonify({"status": "error"}), 400
 
+@app.route('/api/expire/<user_id>', methods=['POST'])
+def expire(user_id):
+    if db.expire_user(user_id):
+        return jsonify({"status": "success"})
     return jsonify({"status": "error", "message": "User not found"}), 404
 
 @app.route('/api/upload_image', methods=['POST'])
@@ -196,8 +321,11 @@ def upload_image():
                 try:
                     if os.path.isfile(file_path): os.unlink(file_path)
                 except: pass
+                media_utils.forget(file_path)
             
-            file.save(os.path.join(photos_dir, file.filename))
+            new_path = os.path.join(photos_dir, file.filename)
+            file.save(new_path)
+            media_utils.forget(new_path)
             return jsonify({"status": "success"})
         except Exception as e:
             return jsonify({"status": "error", "message": str(e)}), 500
@@ -213,6 +341,7 @@ def upload_qr():
     if file:
         try:
             file.save(config.QR_CODE_PATH)
+            media_utils.forget(config.QR_CODE_PATH)
             return jsonify({"status": "success"})
         except Exception as e:
             return jsonify({"status": "error", "message": str(e)}), 500
@@ -229,14 +358,14 @@ def broadcast():
     
     if not message and not file:
         return jsonify({"status": "error", "message": "Message or File is required"}), 400
-        
-    users = db.get_all_users()
     
     reply_markup = None
     if btn_text and btn_url:
         reply_markup = {"inline_keyboard": [[{"text": btn_text, "url": btn_url}]]}
     
-    # Save file temporarily if exists
+    broadcast_id = uuid.uuid4().hex[:10]
+
+    # Keep the file until the broadcast is done (a resumed broadcast may still need it)
     temp_file_path = None
     media_type = None
     if file:
@@ -248,68 +377,40 @@ def broadcast():
         
         if not os.path.exists("static/temp"):
             os.makedirs("static/temp")
-        temp_file_path = os.path.join("static/temp", file.filename)
+        temp_file_path = os.path.join("static/temp", f"{broadcast_id}_{file.filename}")
         file.save(temp_file_path)
 
-    def send_broadcast_thread(temp_path, m_type):
-        sent_count = 0
-        file_id = None # Store file_id after first upload to reuse
-        
-        for user in users:
-            try:
-                # Filter Logic
-                if target == "active" and not user.get("is_subscribed"): continue
-                if target == "expired" and user.get("is_subscribed"): continue
-                
-                chat_id = user['user_id']
-                payload = {
-                    "chat_id": chat_id,
-                    "parse_mode": "Markdown",
-                    "reply_markup": json.dumps(reply_markup) if reply_markup else None
-                }
-                if message: payload["caption" if m_type else "text"] = message
+    db.create_broadcast({
+        "_id": broadcast_id,
+        "message": message,
+        "target": target,
+        "reply_markup": reply_markup,
+        "media_type": media_type,
+        "media_path": temp_file_path
+    })
+    broadcaster.start(broadcast_id)
+    
+    return jsonify({"status": "success", "message": "Broadcast started", "broadcast_id": broadcast_id})
 
-                # CASE 1: Text Only
-                if not m_type:
-                    safe_send_telegram("sendMessage", data=payload)
-                
-                # CASE 2: Media (First Time Upload)
-                elif file_id is None:
-                    with open(temp_path, 'rb') as f:
-                        method = "sendPhoto" if m_type == "photo" else "sendVideo"
-                        files = {m_type: f}
-                        resp = safe_send_telegram(method, data=payload, files=files)
-                        
-                        # Try to extract file_id for optimization
-                        if resp and resp.status_code == 200:
-                            res_json = resp.json()
-                            if m_type == "photo":
-                                file_id = res_json['result']['photo'][-1]['file_id']
-                            elif m_type == "video":
-                                file_id = res_json['result']['video']['file_id']
-                                
-                # CASE 3: Media (Reuse File ID)
-                else:
-                    method = "sendPhoto" if m_type == "photo" else "sendVideo"
-                    payload[m_type] = file_id
-                    safe_send_telegram(method, data=payload)
-
-                sent_count += 1
-                time.sleep(0.05)
-            except Exception as e:
-                print(f"Broadcast error for {user.get('user_id')}: {e}")
-        
-        print(f"Broadcast completed. Sent to {sent_count} users.")
-        
-        # Cleanup
-        if temp_path and os.path.exists(temp_path):
-            os.remove(temp_path)
+@app.route('/api/broadcast/<broadcast_id>', methods=['GET'])
+def broadcast_status(broadcast_id):
+    broadcast = db.get_broadcast(broadcast_id)
+    if not broadcast:
+        return jsonify({"status": "error", "message": "Broadcast not found"}), 404
+    broadcast["active"] = broadcaster.is_active(broadcast)
+    return jsonify({"status": "success", "broadcast": broadcast})
 
-    threading.Thread(target=send_broadcast_thread, args=(temp_file_path, media_type)).start()
-    
-    return jsonify({"status": "success", "message": "Broadcast started"})
+@app.route('/api/broadcast/<broadcast_id>/resume', methods=['POST'])
+def broadcast_resume(broadcast_id):
+    broadcast = db.get_broadcast(broadcast_id)
+    if not broadcast:
+        return jsonify({"status": "error", "message": "Broadcast not found"}), 404
+    if broadcast["status"] == "done" or not broadcaster.start(broadcast_id):
+        return jsonify({"status": "error", "message": "Broadcast is finished or already running"}), 400
+    return jsonify({"status": "success", "message": "Broadcast resumed"})
 
 def run_server():
+    threading.Thread(target=payments_app.run, kwargs={"host": "0.0.0.0", "port": config.PAYMENT_PORT}, daemon=True).start()
     app.run(host='0.0.0.0', port=5050)
 
 if __name__ == '__main__':
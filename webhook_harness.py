@@ -0,0 +1,83 @@
+import argparse
+import itertools
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+import config
+
+# Posts fake Telegram updates to a locally running bot in webhook mode (BOT_MODE=webhook).
+# Usage: python webhook_harness.py --users 50 --taps 5
+#   Every fake user sends /start followed by Next taps; a wrong-secret request must get 403.
+
+_update_ids = itertools.count(int(time.time()))
+
+def fake_user(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"Test{user_id}"}
+
+def start_update(user_id):
+    return {
+        "update_id": next(_update_ids),
+        "message": {
+            "message_id": next(_update_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": fake_user(user_id),
+            "text": "/start",
+            "entities": [{"type": "bot_command", "offset": 0, "length": 6}]
+        }
+    }
+
+def tap_update(user_id, data="vid_next_direct"):
+    return {
+        "update_id": next(_update_ids),
+        "callback_query": {
+            "id": str(next(_update_ids)),
+            "from": fake_user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": next(_update_ids),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "text": "video"
+            }
+        }
+    }
+
+def post(url, update, secret):
+    headers = {"Content-Type": "application/json"}
+    if secret:
+        headers["X-Telegram-Bot-Api-Secret-Token"] = secret
+    return requests.post(url, data=json.dumps(update), headers=headers, timeout=10).status_code
+
+def user_session(url, secret, user_id, taps):
+    codes = [post(url, start_update(user_id), secret)]
+    for _ in range(taps):
+        codes.append(post(url, tap_update(user_id), secret))
+    return codes
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Post fake updates to a local webhook")
+    parser.add_argument("--url", default=f"http://127.0.0.1:{config.WEBHOOK_PORT}/{config.WEBHOOK_PATH}")
+    parser.add_argument("--secret", default=config.WEBHOOK_SECRET)
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--taps", type=int, default=3)
+    parser.add_argument("--first-user-id", type=int, default=900000000)
+    args = parser.parse_args()
+
+    if args.secret:
+        code = post(args.url, start_update(args.first_user_id), "wrong-secret")
+        print(f"Wrong secret -> HTTP {code} ({'OK' if code == 403 else 'EXPECTED 403'})")
+
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=args.users) as pool:
+        results = list(pool.map(
+            lambda uid: user_session(args.url, args.secret, uid, args.taps),
+            range(args.first_user_id, args.first_user_id + args.users)
+        ))
+    elapsed = time.time() - started
+
+    codes = [c for session in results for c in session]
+    ok = sum(1 for c in codes if c == 200)
+    print(f"Posted {len(codes)} updates in {elapsed:.2f}s ({len(codes) / elapsed:.1f}/s), {ok} accepted.")